@@ -0,0 +1,63 @@
+"""
+Training step time of `BnLayer` against `FastBnLayer`, and of a `ResNet` built with each.
+
+    python benchmarks/bench_bnlayer.py --bs 64 --sz 200 --steps 50
+"""
+import argparse, os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import torch, torch.nn.functional as F
+from torch.autograd import Variable
+from models.ResNet import BnLayer, FastBnLayer, ResNet
+
+USE_GPU = torch.cuda.is_available()
+
+
+def sync():
+    if USE_GPU: torch.cuda.synchronize()
+
+
+def step_time(model, x, y, steps, warmup=5):
+    """ Mean seconds per forward + backward + SGD step. """
+    model.train()
+    opt = torch.optim.SGD(model.parameters(), lr=1e-3, momentum=0.9)
+    for i in range(warmup + steps):
+        if i == warmup:
+            sync()
+            start = time.perf_counter()
+        opt.zero_grad()
+        out = model(x)
+        loss = F.nll_loss(out, y) if out.dim() == 2 else out.mean()
+        loss.backward()
+        opt.step()
+    sync()
+    return (time.perf_counter() - start) / steps
+
+
+def cuda(o): return o.cuda() if USE_GPU else o
+
+
+def main(bs, sz, steps, channels):
+    torch.manual_seed(0)
+    x = Variable(cuda(torch.randn(bs, channels, sz, sz)))
+    print(f'{"layer":<28}{"ms/step":>10}')
+    for cls in (BnLayer, FastBnLayer):
+        t = step_time(cuda(cls(channels, channels, stride=1)), x, None, steps)
+        print(f'{cls.__name__:<28}{t * 1e3:10.2f}')
+
+    x = Variable(cuda(torch.randn(bs, 2, sz, sz)))
+    y = Variable(cuda(torch.LongTensor(bs).random_(0, 2)))
+    for fast_bn in (False, True):
+        model = cuda(ResNet([10, 20, 40, 80, 160], 2, 'bench', tb_log=False, fast_bn=fast_bn))
+        t = step_time(model, x, y, steps)
+        print(f'{"ResNet fast_bn=" + str(fast_bn):<28}{t * 1e3:10.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Step time of BnLayer against FastBnLayer.')
+    parser.add_argument('--bs', type=int, default=64)
+    parser.add_argument('--sz', type=int, default=200)
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--channels', type=int, default=32, help='channels of the single-layer benchmark')
+    args = parser.parse_args()
+    main(args.bs, args.sz, args.steps, args.channels)
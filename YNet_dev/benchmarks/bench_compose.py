@@ -0,0 +1,59 @@
+"""
+Per-sample overhead of applying a `Transforms` pipeline.
+
+Compares the old `compose`, which checked `'Normalize' in str(fn)` for every transform of every sample, with the
+pipeline that `Transforms` now resolves once into (fn, uses_src_idx) pairs. Images are tiny so that the time is
+dominated by dispatch rather than by the transforms themselves.
+
+    python benchmarks/bench_compose.py --samples 20000
+"""
+import argparse, os, sys, timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from resources.transforms import *
+
+
+def legacy_compose(im, y, src_idx, fns):
+    """ `compose` before the pipeline was resolved once: builds a repr string per transform and sample. """
+    for fn in fns:
+        if 'Normalize' in str(fn): im, y = fn(im, y, src_idx)
+        else: im, y = fn(im, y)
+    return im if y is None else (im, y)
+
+
+class Noop:
+    def __call__(self, x, y): return x, y
+
+
+def bench(name, fn, n, repeat):
+    best = min(timeit.repeat(fn, number=n, repeat=repeat)) / n
+    print(f'{name:<40}{best * 1e6:10.2f} us/sample')
+    return best
+
+
+def main(samples, sz, repeat):
+    stats = {0: ([0.1, 0.2, 0.3], [0.5, 0.6, 0.7]), 1: ([0.3, 0.2, 0.1], [0.2, 0.3, 0.4])}
+    im = np.random.rand(sz, sz, 3).astype(np.float32)
+    aug = [RandomRotate(10), RandomDihedral(), RandomLighting(0.05, 0.05)]
+    tfms, _ = tfms_from_stats(stats, sz, aug_tfms=aug, crop_type=CropType.CENTER)
+    chain = [Noop() for _ in range(16)] + [Normalize(stats)]
+    chain_pipeline = resolve_tfms(chain)
+
+    print(f'pipeline of {len(tfms.tfms)} transforms, {sz}x{sz} images')
+    old = bench('  legacy compose', lambda: legacy_compose(im, 1, 0, tfms.tfms), samples, repeat)
+    new = bench('  resolved pipeline', lambda: tfms(im, 1, 0), samples, repeat)
+    print(f'  speedup {old / new:.2f}x')
+
+    print(f'{len(chain)} no-op transforms + Normalize')
+    old = bench('  legacy compose', lambda: legacy_compose(im, 1, 0, chain), samples, repeat)
+    new = bench('  resolved pipeline', lambda: run_tfms(im, 1, 0, chain_pipeline), samples, repeat)
+    print(f'  speedup {old / new:.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-sample dispatch overhead of transform pipelines.')
+    parser.add_argument('--samples', type=int, default=20000)
+    parser.add_argument('--sz', type=int, default=4, help='image size; keep it small to isolate dispatch')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    main(args.samples, args.sz, args.repeat)
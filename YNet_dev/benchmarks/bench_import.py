@@ -0,0 +1,47 @@
+"""
+Import time of `resources` modules, each measured in a fresh interpreter.
+
+Also lists which heavy or notebook-only packages each import pulls in; with the lazy imports of `resources.imports`
+a headless script importing `resources.dataloader` or `resources.dataset` should load none of them.
+
+    python benchmarks/bench_import.py --repeat 5
+"""
+import argparse, os, subprocess, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ['IPython', 'ipykernel', 'ipywidgets', 'seaborn', 'matplotlib', 'pandas', 'scipy', 'sklearn', 'sklearn_pandas',
+         'graphviz', 'bcolz', 'pandas_summary', 'isoweek', 'torchtext', 'skimage']
+
+PROBE = '''
+import sys, time
+t = time.perf_counter()
+import {module}
+dt = time.perf_counter() - t
+print(dt)
+print(' '.join(m for m in {heavy!r} if m in sys.modules))
+'''
+
+
+def import_time(module):
+    out = subprocess.run([sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY)], cwd=ROOT,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if out.returncode: raise RuntimeError(f'importing {module} failed:\n{out.stderr}')
+    dt, loaded = (out.stdout.splitlines() + [''])[:2]
+    return float(dt), loaded.split()
+
+
+def main(modules, repeat):
+    print(f'{"module":<28}{"best s":>8}{"mean s":>8}  heavy packages loaded')
+    for module in modules:
+        runs = [import_time(module) for _ in range(repeat)]
+        times = [dt for dt, _ in runs]
+        print(f'{module:<28}{min(times):8.2f}{sum(times) / len(times):8.2f}  {" ".join(runs[0][1]) or "-"}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import time of resources modules in fresh interpreters.')
+    parser.add_argument('modules', nargs='*', default=['resources.dataloader', 'resources.dataset',
+                                                       'resources.conv_learner'])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    main(args.modules, args.repeat)
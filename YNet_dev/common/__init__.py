@@ -1,2 +1,2 @@
 from common.data_source import dataset_source, Statistics
-from common.dataset_manipulation import shuffle_zip
\ No newline at end of file
+from common.dataset_manipulation import shuffle_zip, build_dataset
\ No newline at end of file
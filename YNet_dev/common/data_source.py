@@ -1,5 +1,6 @@
-import pickle, os
+import pickle, os, contextlib
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import skimage.external.tifffile as tiff
 from resources.conv_learner import *
@@ -17,6 +18,77 @@ def dataset_source(source:  Path) -> tuple:
                     elif 'train' in str(class_dir): train_dirs.append(class_dir)
     return test_dirs, train_dirs
 
+class RunningStats:
+    """
+    Per-channel mean and variance of a stream of images, accumulated with Welford/Chan updates.
+
+    Only the count, mean and sum of squared deviations per channel are kept, so memory does not grow with the number
+    of images. Partial results computed on different files or processes are combined exactly with `merge`.
+    """
+
+    def __init__(self, n=0, mean=None, m2=None):
+        self.n, self.mean, self.m2 = n, mean, m2
+
+    def update(self, image, channel_axis=0):
+        x = np.moveaxis(np.asarray(image, dtype=np.float64), channel_axis, 0)
+        x = x.reshape(x.shape[0], -1)
+        mean = x.mean(axis=1)
+        m2 = np.square(x - mean[:, None]).sum(axis=1)
+        return self.merge(RunningStats(x.shape[1], mean, m2))
+
+    def merge(self, other):
+        if other.n == 0: return self
+        if self.n == 0:
+            self.n, self.mean, self.m2 = other.n, other.mean.copy(), other.m2.copy()
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.n / n)
+        self.m2 = self.m2 + other.m2 + np.square(delta) * (self.n * other.n / n)
+        self.n = n
+        return self
+
+    @property
+    def var(self): return self.m2 / self.n  # population variance, like np.var
+
+    @property
+    def std(self): return np.sqrt(self.var)
+
+
+def accumulate_stats(files) -> RunningStats:
+    """ Reads each file once and returns the running per-channel moments of all of them. """
+    stats = RunningStats()
+    for file in files:
+        stats.update(tiff.imread(str(file)))
+    return stats
+
+
+def image_stats(file) -> tuple:
+    """ Per-channel (mean, stdev) of a single image, used by `Statistics.per_class(inspect=True)` """
+    stats = RunningStats().update(tiff.imread(str(file)))
+    return stats.mean, stats.std
+
+
+def parallel_stats(files, executor=None, jobs=None) -> RunningStats:
+    """
+    Fans `accumulate_stats` out over an executor with one shard of files per worker and merges the partial moments.
+    The merge is exact, so the result matches a serial pass. Without an executor, files are processed serially.
+    """
+    files = list(files)
+    if executor is None or len(files) < 2: return accumulate_stats(files)
+    jobs = jobs or num_cpus()
+    stats = RunningStats()
+    for shard_stats in executor.map(accumulate_stats, [files[i::jobs] for i in range(jobs)]):
+        stats.merge(shard_stats)
+    return stats
+
+
+def stats_executor(jobs=None):
+    """ Process pool for `parallel_stats`; jobs=None uses every core, jobs=1 disables the pool. """
+    jobs = jobs or num_cpus()
+    return ProcessPoolExecutor(jobs) if jobs > 1 else contextlib.suppress()
+
+
 class Statistics:
 
     @staticmethod
@@ -28,28 +100,29 @@ class Statistics:
         return classes
 
     @staticmethod
-    def per_class(zipped: zip, norm_value=65536, save_name='', inspect = False) -> dict:
+    def per_class(zipped: zip, norm_value=65536, save_name='', inspect = False, jobs=None) -> dict:
+        """ jobs: number of worker processes; None uses every core, 1 computes serially. """
         stats = {}
 
-        for t in zipped:
-            class_images = [] # bug fixed
-            for class_dir in t: # t is a tuple
-                class_name = class_dir.name
-                # read from each dir and append to the images
-                for file in class_dir.iterdir():
-                    image = tiff.imread(str(file))
-                    class_images.append(image)
-
-                # print(f"working on: {class_name}")
-                print(f"working on: {class_dir}")
-                if inspect == False:    
-                    mean = np.mean(class_images, axis=(0, 2, 3)) / norm_value
-                    stdev = np.std(class_images, axis=(0, 2, 3)) / norm_value
-                else: 
-                    mean = np.mean(class_images, axis=(2, 3)) #/ norm_value
-                    stdev = np.std(class_images, axis=(2, 3)) #/ norm_value
-
-                stats[class_name] = (mean, stdev)
+        with stats_executor(jobs) as executor:
+            for t in zipped:
+                class_stats = RunningStats() # accumulates over every dir in t, like the former image list
+                means, stdevs = [], []
+                for class_dir in t: # t is a tuple
+                    class_name = class_dir.name
+                    files = list(class_dir.iterdir())
+
+                    # print(f"working on: {class_name}")
+                    print(f"working on: {class_dir}")
+                    if inspect == False:
+                        class_stats.merge(parallel_stats(files, executor, jobs))
+                        stats[class_name] = (class_stats.mean / norm_value, class_stats.std / norm_value)
+                    else: # per image statistics
+                        mapper = executor.map(image_stats, files, chunksize=64) if executor else map(image_stats, files)
+                        for mean, stdev in mapper:
+                            means.append(mean) #/ norm_value
+                            stdevs.append(stdev) #/ norm_value
+                        stats[class_name] = (np.array(means), np.array(stdevs))
 
         if save_name:
             Statistics.pickle(stats, save_name+".per_class.dict")  # if save is given it should be a string; empty strings are false
@@ -62,20 +135,18 @@ class Statistics:
             pickle.dump(stats, file)
 
     @staticmethod
-    def per_dataset(test_dirs:[Path], train_dirs:[Path], norm_value=65536, save_name='') -> tuple:
+    def per_dataset(test_dirs:[Path], train_dirs:[Path], norm_value=65536, save_name='', jobs=None) -> tuple:
+        """ jobs: number of worker processes; None uses every core, 1 computes serially. """
 
         _dirs = [*test_dirs, *train_dirs]
         print(len(_dirs))
-        images = []
-        for _dir in _dirs:
-            for file in _dir.iterdir():
-                if ".tif" in str(file):
-                    image = tiff.imread(str(file))
-                    images.append(image)
+        files = [file for _dir in _dirs for file in _dir.iterdir() if ".tif" in str(file)]
 
-        print(f"working on a dataset with length: {len(images)}")
-        mean = np.mean(images, axis=(0, 2, 3)) / norm_value
-        stdev = np.std(images, axis=(0, 2, 3)) / norm_value
+        print(f"working on a dataset with length: {len(files)}")
+        with stats_executor(jobs) as executor:
+            dataset_stats = parallel_stats(files, executor, jobs)
+        mean = dataset_stats.mean / norm_value
+        stdev = dataset_stats.std / norm_value
 
         stats = (mean, stdev)
         if save_name:
@@ -95,3 +166,24 @@ class Statistics:
 
         print(f"sources [{len(images)}] images")
         return images
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Computes the normalization statistics of a dataset tree.')
+    parser.add_argument('root', help='dataset root containing the train/val/test folders')
+    parser.add_argument('--splits', nargs='+', default=['train', 'val'],
+                        help='splits whose class folders are combined per class, e.g. train val')
+    parser.add_argument('--per-dataset', action='store_true', help='one (mean, stdev) for the whole dataset')
+    parser.add_argument('--save-name', default='', help='prefix of the pickled statistics')
+    parser.add_argument('--jobs', type=int, default=None, help='worker processes, defaults to every core')
+    args = parser.parse_args()
+
+    root = Path(args.root)
+    if args.per_dataset:
+        result = Statistics.per_dataset(*dataset_source(root), save_name=args.save_name, jobs=args.jobs)
+    else:
+        classes = Statistics.source_class(root)
+        zipped = zip(*[sorted(classes[split]) for split in args.splits])
+        result = Statistics.per_class(zipped, save_name=args.save_name, jobs=args.jobs)
+    print(result)
@@ -1,7 +1,11 @@
+import csv
+import io
 import os
-import random
+import re
 import shutil
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from os.path import \
     basename  # required to use in zipfile.Zipfile.write(file, basename(file)) to avoid completed path to be archived
 from pathlib import Path
@@ -9,8 +13,16 @@ from skimage.external import tifffile as tiff
 from typing import List
 from zipfile import ZipFile
 
+import numpy as np
 
-def shuffle_zip(zips_path: str, output_path: str, ready_path: str, val=False):
+from common.tiff_meta import TiffIndex, read_tiff_meta
+
+
+SPLIT_SEED = 1  # default seed of the train/test split, so re-running a notebook gives the same split
+
+
+def shuffle_zip(zips_path: str, output_path: str, ready_path: str, val=False, ntest=70, seed=SPLIT_SEED,
+                factors=('E',), manifest=True):
     """
     Function to unzip, shuffle, re-zip and store a set of images at a specified location.
     Arguments:
@@ -20,6 +32,9 @@ def shuffle_zip(zips_path: str, output_path: str, ready_path: str, val=False):
     -> creates temp folder in same directory as .zip file to store unzipped files in, but deletes it once done.
     -> shuffles and splits unzipped files between train, test and optionally val datasets.
     -> optionally re-zip or storage in hdf5 object (TODO)
+    ntest, seed, factors: see `stratified_split`
+    manifest: record each class' split in ready_path/<dataset_name>.split.csv, see `read_manifest`
+    `build_dataset` produces the same layout in a single parallel pass.
     """
     temp_dir = 'TEMP_UNZIP'  # Path definition, also for later use
     if os.path.exists(temp_dir):
@@ -46,7 +61,10 @@ def shuffle_zip(zips_path: str, output_path: str, ready_path: str, val=False):
 
         delete_non_square(temp_ds_path)
 
-        test_addrs, train_addrs = split_images(temp_ds_path)
+        split_manifest = os.path.join(ready_path, f'{dataset_name}.split.csv') if manifest else None
+        if split_manifest: os.makedirs(ready_path, exist_ok=True)
+        test_addrs, train_addrs = split_images(temp_ds_path, ntest=ntest, seed=seed, factors=factors,
+                                               manifest=split_manifest)
 
         # zip shuffled images and store at output_path
         zipup(output_path, test_addrs, train_addrs, dataset_name, class_dir)
@@ -57,31 +75,224 @@ def shuffle_zip(zips_path: str, output_path: str, ready_path: str, val=False):
 
 
 
-def split_images(temp_path, shuffle_data=True):
+def split_images(temp_path, shuffle_data=True, ntest=70, seed=SPLIT_SEED, factors=('E',), manifest=None):
+    """ `stratified_split` of the images in temp_path; the manifest records their names, not the temporary paths """
     if not isinstance(temp_path, Path): temp_path = Path(temp_path)
-    # random.seed(1)  # reproducible randomness
-    ntest = 70 # per experiment per class
 
     # get list of files in TempPath
-    addrs = [addr for addr in temp_path.iterdir()]  # e.g. /mmr1/mmr1_WP_E1_S2_F1_I6_C10_A0.tifstack.tif
-    # create shuffled list
-    if shuffle_data:
-        addrs = random.sample(addrs, k=len(addrs))  # creates shuffled list by random sampling from original list.
+    addrs = {addr.name: addr for addr in temp_path.iterdir()}  # e.g. /mmr1/mmr1_WP_E1_S2_F1_I6_C10_A0.tifstack.tif
+    test, train = stratified_split(addrs, ntest, seed, factors, shuffle_data, manifest)
+    test, train = [addrs[o] for o in test], [addrs[o] for o in train]
+
+    print(f"length of train: [{len(train)}]; length of test: [{len(test)}]")
+    return test, train
+
+
+def filename_factors(addr, factors=('E',)) -> tuple:
+    """
+    Values of the factors encoded in an image name, e.g. ('E1', 'F1') for factors ('E', 'F') of
+    mmr1/mmr1_WP_E1_S2_F1_I6_C10_A0.tifstack.tif. The factor 'class' is the parent folder name, or the first
+    token of the name when it has no folder; missing factors are ''.
+    """
+    addr = Path(addr)
+    values = []
+    for factor in factors:
+        if factor == 'class':
+            values.append(addr.parent.name or addr.name.split('_')[0])
+        else:
+            match = re.search(rf'(?:^|_)({re.escape(factor)}\d+)(?=[_.]|$)', addr.name)
+            values.append(match.group(1) if match else '')
+    return tuple(values)
+
+
+def stratified_split(addrs, ntest=70, seed=SPLIT_SEED, factors=('E',), shuffle_data=True, manifest=None):
+    """
+    Picks test images per stratum, a combination of the `factors` encoded in the image names (see `filename_factors`),
+    e.g. factors=('class', 'E') takes ntest images of every class from every experiment. The others are for training.
+
+    Every experiment is its own stratum: with E1/E2 data the default factors=('E',) match the former E1 / not E1
+    split, but data from a third experiment now gets ntest test images of its own instead of sharing the not E1 quota.
 
-    is_exp1 = [True if "E1" in str(addr) else False for addr in addrs]
+    Names are sorted before they are shuffled, so a seed gives the same split whatever the directory listing order.
+
+    Arguments:
+    ntest: test images per stratum, or a dict from stratum (the factor values joined by '_', e.g. 'mmr1_E2') to count
+    seed: seed of the shuffle, fixed by default; None gives a different split on every call
+    shuffle_data: False takes the first ntest images of every stratum in name order
+    manifest: path of a csv file to record the split in, see `read_manifest`
+
+    Returns:
+    test, train: lists of addrs, in name order
+    """
+    addrs = sorted(addrs, key=str)
+    strata, inverse = np.unique(['_'.join(filename_factors(a, factors)) for a in addrs], return_inverse=True)
+    inverse = inverse.reshape(-1)
+    if isinstance(ntest, dict):
+        missing = [s for s in strata if s not in ntest]
+        if missing: raise ValueError(f'no test counts for strata {missing}')
+        counts = np.array([ntest[s] for s in strata], dtype=int)
+    else:
+        counts = np.full(len(strata), ntest, dtype=int)
+    sizes = np.bincount(inverse, minlength=len(strata))
+    if (sizes < counts).any():
+        short = {s: (n, c) for s, n, c in zip(strata, sizes, counts) if n < c}
+        raise ValueError(f'too few images for the test set, (images, needed) per stratum: {short}')
+
+    n = len(addrs)
+    order = np.random.RandomState(seed).permutation(n) if shuffle_data else np.arange(n)
+    order = order[np.argsort(inverse[order], kind='mergesort')]  # grouped by stratum, shuffled within
+    rank = np.empty(n, dtype=int)
+    rank[order] = np.arange(n) - np.repeat(np.cumsum(sizes) - sizes, sizes)  # position within the stratum
+    is_test = rank < counts[inverse]
+
+    test = [a for a, t in zip(addrs, is_test) if t]
+    train = [a for a, t in zip(addrs, is_test) if not t]
+    if manifest: write_manifest(manifest, addrs, strata[inverse], is_test)
+    return test, train
+
+
+def write_manifest(manifest, addrs, strata, is_test):
+    """ Writes the name, stratum and split of every image as csv, in name order """
+    with open(str(manifest), 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['name', 'stratum', 'split'])
+        for addr, stratum, t in zip(addrs, strata, is_test):
+            writer.writerow([str(addr), stratum, 'test' if t else 'train'])
+
+
+def read_manifest(manifest) -> tuple:
+    """ The test and train names recorded by `stratified_split`, to rebuild a split without reading any images """
     test, train = [], []
-    sampling = set(is_exp1)
-    print(sampling)
-    print(is_exp1.count(True), is_exp1.count(False))
-    for i in range(ntest):
-        for condition in sampling:
-            idx = is_exp1.index(condition)
-            test.append(addrs[idx])
-            del addrs[idx]
-            del is_exp1[idx]
+    with open(str(manifest), newline='') as f:
+        for row in csv.DictReader(f):
+            (test if row['split'] == 'test' else train).append(row['name'])
+    return test, train
+
 
-    print(f"length of train: [{len(addrs)}]; length of test: [{len(test)}]")
-    return test, addrs
+def build_dataset(zips_path: str, ready_path: str, size=200, ntest=70, seed=SPLIT_SEED, packed=False, jobs=None,
+                  manifest=None):
+    """
+    Streaming replacement of `shuffle_zip` + `ready_data`: builds ready_path/{train,test}/<dataset_name>/ straight from
+    the class zips in zips_path, without the temporary extraction and intermediate zips.
+
+    Image shapes are read from the TIFF headers of the zip members, so non square images are skipped without decoding
+    them. The remaining images are split like `split_images` (`ntest` per experiment per class) and copied from the zip
+    to their final location, or with packed=True decoded once into the packed array store of `pack_folder`
+    (ready_path/{train,test}.x.npy and .meta.npz, readable with `ImageClassifierData.prepare_from_packed`).
+    Zip members are read and written across a pool of `jobs` processes.
+
+    Arguments:
+    ntest, seed: see `stratified_split`, whose strata are (class, experiment); ntest dict keys are e.g. 'WT_175_E1'
+    manifest: path of a csv file to record the split in, see `stratified_split`
+    """
+    zips = sorted(p for p in Path(zips_path).iterdir() if p.suffix == '.zip')
+    jobs = jobs or os.cpu_count()
+    images = {}  # dataset_name/image name: (zip path, member name, dataset_name)
+
+    with ProcessPoolExecutor(jobs) as executor:
+        members = {z: zip_images(z) for z in zips}
+        metas = {z: executor.map(member_metas, repeat(str(z)), chunks(members[z], jobs)) for z in zips}
+
+        for z in zips:
+            dataset_name = extract_ds_name(z)
+            metas[z] = [meta for chunk in metas[z] for meta in chunk]
+            keep = [name for name, meta in zip(members[z], metas[z]) if meta.shape[-2:] == (size, size)]
+            print(f"[{dataset_name}]: skipping {len(members[z]) - len(keep)} non square images.")
+            images.update({f'{dataset_name}/{basename(name)}': (str(z), name, dataset_name) for name in keep})
+
+        test, train = stratified_split(images, ntest, seed, ('class', 'E'), manifest=manifest)
+        splits = {'train': [images[o] for o in train], 'test': [images[o] for o in test]}
+
+        if packed:
+            metas = {(str(z), name): meta for z in zips for name, meta in zip(members[z], metas[z])}
+            pack_splits(executor, jobs, splits, metas, ready_path)
+        else:
+            for split, images in splits.items():
+                for dataset_name in sorted({o[2] for o in images}):
+                    dest = os.path.join(ready_path, split, dataset_name)
+                    if os.path.exists(dest):
+                        raise ValueError(f'WARNING: {dest} exists already - process cancelled to avoid overwriting')
+                    os.makedirs(dest)
+                tasks = [(z, name, os.path.join(ready_path, split, dataset_name, basename(name)))
+                         for z, name, dataset_name in images]
+                for _ in executor.map(extract_members, chunks(tasks, jobs)): pass
+                print(f"{len(tasks)} images written to {os.path.join(ready_path, split)}")
+
+
+def pack_splits(executor, jobs, splits, metas, ready_path):
+    """ Writes each split of `build_dataset` into the packed array store of `pack_folder` """
+    from resources.dataset import label_arrays, save_packed_meta
+
+    os.makedirs(ready_path, exist_ok=True)
+    d = {}  # label dictionary shared between the splits, like in `pack_from_path`
+    for split, images in splits.items():
+        shapes = {metas[o[:2]].shape for o in images}
+        dtypes = {metas[o[:2]].dtype for o in images}
+        if len(shapes) != 1: raise ValueError(f'Expected a single image shape in {split}, found {sorted(shapes)}')
+        if dtypes != {np.dtype(np.uint16)}: raise ValueError(f'Expected 16-bit images in {split}, found {dtypes}')
+
+        x_path = os.path.join(ready_path, f'{split}.x.npy')
+        x = np.lib.format.open_memmap(x_path, mode='w+', dtype=np.uint16, shape=(len(images),) + shapes.pop())
+        del x  # workers write through their own memory maps
+
+        tasks = [(z, name, x_path, row) for row, (z, name, _) in enumerate(images)]
+        for _ in executor.map(pack_members, chunks(tasks, jobs)): pass
+
+        lbls = [dataset_name for _, _, dataset_name in images]
+        all_lbls = sorted(set(lbls))
+        cls_idx_arr, u_classes, src_idx_arr = label_arrays(lbls, all_lbls, d)
+        fnames = [os.path.join(split, dataset_name, basename(name)) for _, name, dataset_name in images]
+        save_packed_meta(ready_path, split, fnames, cls_idx_arr, u_classes, src_idx_arr, all_lbls, d)
+        print(f"{len(images)} images packed into {x_path}")
+
+
+def zip_images(zip_path) -> List[str]:
+    """ Sorted names of the TIFF members of a zip, without folders and macOS metadata """
+    with ZipFile(str(zip_path)) as zip_ref:
+        names = [o.filename for o in zip_ref.infolist() if not o.is_dir()]
+    return sorted(o for o in names if o.lower().endswith(('.tif', '.tiff'))
+                  and '__MACOSX' not in o and not basename(o).startswith('._'))
+
+
+def chunks(items, jobs) -> list:
+    """ About 4 contiguous chunks of items per worker, to balance the pool without a task per item """
+    n = max(1, -(-len(items) // (jobs * 4)))
+    return [items[i:i + n] for i in range(0, len(items), n)]
+
+
+def member_metas(zip_path, names) -> list:
+    """ `TiffMeta` of each zip member, read from its headers """
+    metas = []
+    with ZipFile(zip_path) as zip_ref:
+        for name in names:
+            with zip_ref.open(name) as f:
+                metas.append(read_tiff_meta(f if f.seekable() else io.BytesIO(f.read())))
+    return metas
+
+
+def extract_members(tasks) -> None:
+    """ Copies (zip path, member name, destination) members to their destination """
+    zip_refs = {}
+    try:
+        for zip_path, name, dest in tasks:
+            if zip_path not in zip_refs: zip_refs[zip_path] = ZipFile(zip_path)
+            with zip_refs[zip_path].open(name) as src, open(dest, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+    finally:
+        for zip_ref in zip_refs.values(): zip_ref.close()
+
+
+def pack_members(tasks) -> None:
+    """ Decodes (zip path, member name, array path, row) members into rows of a packed .npy array """
+    zip_refs, arrays = {}, {}
+    try:
+        for zip_path, name, x_path, row in tasks:
+            if zip_path not in zip_refs: zip_refs[zip_path] = ZipFile(zip_path)
+            if x_path not in arrays: arrays[x_path] = np.load(x_path, mmap_mode='r+')
+            arrays[x_path][row] = tiff.imread(io.BytesIO(zip_refs[zip_path].read(name)))
+        for x in arrays.values(): x.flush()
+    finally:
+        for zip_ref in zip_refs.values(): zip_ref.close()
 
 
 def zipup(save_path, test_addrs, train_addrs, dataset_name, temp_path, verbose=False, val_addrs=None):
@@ -139,16 +350,17 @@ def extract_ds_name(input_path: Path) -> str:
     return dataset_name
 
 
-def delete_non_square(path: Path, size=200):
-    deleted = 0
-    for path in path.iterdir():
-        image = tiff.imread(str(path))
-        shape = image.shape
-        if shape[-1] != size or shape[-2] != size:
-            os.remove(str(path))
-            deleted += 1
+def delete_non_square(path: Path, size=200, cache=None):
+    """ Deletes the images below path that are not size x size, and the files that are not readable TIFFs; shapes are
+        read from the TIFF headers by `TiffIndex`.
+        cache: index file name to reuse between runs, see `TiffIndex` """
+    index = TiffIndex(path, cache)
+    wrong_size, invalid = index.wrong_size(size), index.invalid()
+    for image_path in wrong_size + invalid: os.remove(image_path)
+    if cache: index.refresh()
 
-    print(f"deleted {deleted} non square images.")
+    print(f"deleted {len(wrong_size)} non square images.")
+    if invalid: print(f"deleted {len(invalid)} unreadable images, e.g. {invalid[0]}")
 
 
 def get_files(root_path: Path, files=[]) -> list:
@@ -0,0 +1,176 @@
+import json, os, struct
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+TiffMeta = namedtuple('TiffMeta', ['shape', 'dtype'])
+
+# tags read from the first IFD
+IMAGE_WIDTH, IMAGE_LENGTH, BITS_PER_SAMPLE, SAMPLES_PER_PIXEL, PLANAR_CONFIG, SAMPLE_FORMAT = 256, 257, 258, 277, 284, 339
+TAGS = {IMAGE_WIDTH, IMAGE_LENGTH, BITS_PER_SAMPLE, SAMPLES_PER_PIXEL, PLANAR_CONFIG, SAMPLE_FORMAT}
+FIELD_TYPES = {1: 'B', 3: 'H', 4: 'I', 16: 'Q'}  # BYTE, SHORT, LONG, LONG8: the types these tags are stored as
+SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+
+def read_tiff_meta(f) -> TiffMeta:
+    """
+    Shape and dtype of a TIFF (or BigTIFF) file, parsed from its IFD headers without reading any pixel data.
+
+    The shape follows `tifffile.imread` for the stacks in our datasets: (pages, H, W) for a multi-page stack,
+    (H, W) for a single page, with a samples axis when a page holds more than one sample per pixel.
+
+    Arguments:
+        f: binary file object supporting seek, e.g. `open(path, 'rb')` or a member of a `ZipFile`
+    """
+    head = f.read(16)
+    byteorder = {b'II': '<', b'MM': '>'}.get(head[:2])
+    if byteorder is None: raise ValueError('not a TIFF file')
+    version = struct.unpack(byteorder + 'H', head[2:4])[0]
+    if version == 42: count_fmt, offset_fmt, offset = 'H', 'I', struct.unpack(byteorder + 'I', head[4:8])[0]
+    elif version == 43: count_fmt, offset_fmt, offset = 'Q', 'Q', struct.unpack(byteorder + 'Q', head[8:16])[0]
+    else: raise ValueError(f'unknown TIFF version {version}')
+    entry_fmt = byteorder + 'HH' + offset_fmt + ('4s' if version == 42 else '8s')
+    entry_size, count_size, offset_size = (struct.calcsize(byteorder + o) for o in (entry_fmt[1:], count_fmt, offset_fmt))
+
+    tags, pages, seen = None, 0, set()
+    while offset and offset not in seen:
+        seen.add(offset)
+        f.seek(offset)
+        n = struct.unpack(byteorder + count_fmt, f.read(count_size))[0]
+        entries = f.read(n * entry_size)
+        next_offset = struct.unpack(byteorder + offset_fmt, f.read(offset_size))[0]
+        if tags is None: tags = read_tags(f, entries, n, entry_fmt, byteorder, offset_fmt)
+        pages += 1
+        offset = next_offset
+    if not pages: raise ValueError('TIFF file has no images')
+
+    samples = tags.get(SAMPLES_PER_PIXEL, 1)
+    shape = (tags[IMAGE_LENGTH], tags[IMAGE_WIDTH])
+    if samples > 1: shape = (samples,) + shape if tags.get(PLANAR_CONFIG, 1) == 2 else shape + (samples,)
+    if pages > 1: shape = (pages,) + shape
+    dtype = np.dtype(SAMPLE_KINDS.get(tags.get(SAMPLE_FORMAT, 1), 'u') + str(tags.get(BITS_PER_SAMPLE, 1) // 8))
+    return TiffMeta(shape, dtype)
+
+
+def read_tags(f, entries, n, entry_fmt, byteorder, offset_fmt) -> dict:
+    """ First value of each tag of `TAGS` in the raw IFD `entries`; values that do not fit the entry are read from f """
+    tags, size = {}, struct.calcsize(entry_fmt)
+    for i in range(n):
+        tag, field_type, count, value = struct.unpack(entry_fmt, entries[i * size:(i + 1) * size])
+        if tag not in TAGS or field_type not in FIELD_TYPES or not count: continue
+        fmt = byteorder + FIELD_TYPES[field_type]
+        if struct.calcsize(fmt) * count > len(value):  # stored elsewhere, value holds the offset
+            f.seek(struct.unpack(byteorder + offset_fmt, value)[0])
+            value = f.read(struct.calcsize(fmt))
+        tags[tag] = struct.unpack(fmt, value[:struct.calcsize(fmt)])[0]
+    return tags
+
+
+def tiff_meta(path) -> TiffMeta:
+    """ `read_tiff_meta` of the file at path """
+    with open(str(path), 'rb') as f:
+        return read_tiff_meta(f)
+
+
+def try_tiff_meta(path):
+    """ `tiff_meta`, or None for files that are not readable TIFFs """
+    try: return tiff_meta(path)
+    except (OSError, ValueError, KeyError, struct.error): return None
+
+
+class TiffIndex:
+    """
+    Shape and dtype of every TIFF file below `root`, read from the IFD headers only.
+
+    Headers are parsed in a thread pool and cached in a small JSON index (by default `<root>/.tiff_index.json`) keyed by
+    the relative path and mtime of each file, so after the first scan only new or modified files are parsed again.
+    Shapes have the channel axis first, like the stacks in our datasets: (C, H, W), or (H, W) for a single channel.
+
+    Arguments:
+        root: directory to index, searched recursively
+        cache: path of the index file, None to keep the index in memory only
+        jobs: threads parsing headers, defaults to 4 per cpu since the work is waiting on storage
+    """
+
+    def __init__(self, root, cache='.tiff_index.json', jobs=None):
+        self.root = str(root)
+        self.cache = None if cache is None else os.path.join(self.root, cache)
+        self.jobs = jobs or 4 * (os.cpu_count() or 1)
+        self.refresh()
+
+    def refresh(self):
+        """ Rescans root, parsing only the files that are not in the cache with their current mtime """
+        cached = self.load_cache()
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames.sort()
+            for fn in sorted(filenames):
+                if fn.lower().endswith(('.tif', '.tiff')) and not fn.startswith('._'):
+                    path = os.path.join(dirpath, fn)
+                    files[os.path.relpath(path, self.root)] = os.stat(path).st_mtime_ns
+
+        stale = [rel for rel, mtime in files.items() if rel not in cached or cached[rel][0] != mtime]
+        with ThreadPoolExecutor(self.jobs) as e:
+            metas = e.map(try_tiff_meta, [os.path.join(self.root, rel) for rel in stale])
+            for rel, meta in zip(stale, metas):
+                cached[rel] = [files[rel]] + ([None, None] if meta is None else [list(meta.shape), meta.dtype.name])
+
+        self.entries = {rel: cached[rel] for rel in files}
+        if self.cache and (stale or len(cached) != len(files)): self.save_cache()
+        return self
+
+    def load_cache(self) -> dict:
+        if not self.cache or not os.path.exists(self.cache): return {}
+        with open(self.cache) as f: index = json.load(f)
+        return index['files'] if index.get('version') == 1 else {}
+
+    def save_cache(self):
+        tmp = self.cache + '.tmp'
+        with open(tmp, 'w') as f: json.dump({'version': 1, 'files': self.entries}, f)
+        os.replace(tmp, self.cache)
+
+    def __len__(self): return len(self.entries)
+
+    def __iter__(self):
+        """ (path, TiffMeta) of every readable file """
+        for rel, (_, shape, dtype) in self.entries.items():
+            if shape is not None: yield os.path.join(self.root, rel), TiffMeta(tuple(shape), np.dtype(dtype))
+
+    def select(self, fn) -> list:
+        """ Paths of the readable files whose TiffMeta satisfies fn """
+        return [path for path, meta in self if fn(meta)]
+
+    def wrong_size(self, size=200) -> list:
+        """ Paths of the images that are not size x size """
+        return self.select(lambda meta: meta.shape[-2:] != (size, size))
+
+    def invalid(self) -> list:
+        """ Paths of the files whose headers could not be parsed """
+        return [os.path.join(self.root, rel) for rel, (_, shape, _) in self.entries.items() if shape is None]
+
+    def channel_histogram(self) -> Counter:
+        """ Number of images per channel count """
+        return Counter(channels(meta.shape) for _, meta in self)
+
+    def dtype_histogram(self) -> Counter:
+        return Counter(meta.dtype.name for _, meta in self)
+
+
+def channels(shape) -> int:
+    return int(np.prod(shape[:-2])) if len(shape) > 2 else 1
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Validates the shapes of a tree of TIFF images from their headers.')
+    parser.add_argument('root', help='directory searched recursively for TIFF files')
+    parser.add_argument('--size', type=int, default=200, help='expected height and width')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or write the index file')
+    args = parser.parse_args()
+
+    index = TiffIndex(args.root, cache=None if args.no_cache else '.tiff_index.json')
+    wrong, invalid = index.wrong_size(args.size), index.invalid()
+    print(f"{len(index)} files, channels: {dict(index.channel_histogram())}, dtypes: {dict(index.dtype_histogram())}")
+    print(f"{len(wrong)} images are not {args.size}x{args.size}, {len(invalid)} files are not readable")
+    for path in wrong + invalid: print(path)
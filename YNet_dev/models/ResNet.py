@@ -1,16 +1,66 @@
 import torch, torch.nn as nn, torch.nn.functional as F
 from tensorboardX import SummaryWriter
+from collections import deque
 from datetime import datetime
-import os
+import copy, os
+
+
+class ActivationLog:
+    """
+    Bounded capture of a layer's activations.
+
+    One forward call in `every` is captured, and only the last `capacity` captures are kept. Captures are detached from
+    the graph and stay on their device until `export`. mode decides what is kept of an (N,C,H,W) activation:
+        'summary':    per-channel mean and std
+        'histogram':  at most `max_values` activation values, taken at a regular stride
+        'downsample': the activations average pooled by `pool`
+    """
+
+    def __init__(self, capacity=32, every=1, mode='summary', pool=4, max_values=4096):
+        if mode not in ('summary', 'histogram', 'downsample'): raise ValueError(f'unknown mode: {mode}')
+        self.every, self.mode, self.pool, self.max_values = every, mode, pool, max_values
+        self.records = deque(maxlen=capacity)
+        self.calls = 0
+
+    def __len__(self): return len(self.records)
+
+    def __iter__(self): return iter(self.records)
+
+    def __call__(self, x):
+        self.calls += 1
+        if (self.calls - 1) % self.every: return
+        x = x.detach()
+        if self.mode == 'summary':
+            x_chan = x.transpose(0, 1).contiguous().view(x.size(1), -1)
+            rec = (x_chan.mean(1), x_chan.std(1))
+        elif self.mode == 'histogram':
+            flat = x.contiguous().view(-1)
+            rec = flat[::max(1, flat.size(0) // self.max_values)].clone()
+        else:
+            rec = F.avg_pool2d(x, self.pool)
+        self.records.append((self.calls, rec))
+
+    def export(self, writer, tag):
+        """ Writes the kept captures to a tensorboardX writer, stepped by forward call, and drops them. """
+        to_np = lambda t: (t.data if hasattr(t, 'data') else t).cpu().numpy()
+        for call, rec in self.records:
+            if self.mode == 'summary':
+                writer.add_histogram(f'{tag}/channel_mean', to_np(rec[0]), call)
+                writer.add_histogram(f'{tag}/channel_std', to_np(rec[1]), call)
+            else:
+                writer.add_histogram(f'{tag}/activations', to_np(rec), call)
+        self.records.clear()
+
 
 class BnLayer(nn.Module):
-    def __init__(self, ni, nf, stride=2, kernel_size=3,log=False):
+    def __init__(self, ni, nf, stride=2, kernel_size=3,log=False, log_capacity=32, log_every=1, log_mode='summary'):
+        """ log: capture training activations into a bounded `ActivationLog`, see there for log_capacity, log_every, log_mode """
         super().__init__()
         self.conv = nn.Conv2d(ni, nf, kernel_size=kernel_size, stride=stride,
                               bias=False, padding=1)
         self.a = nn.Parameter(torch.zeros(nf, 1, 1))
         self.m = nn.Parameter(torch.ones(nf, 1, 1))
-        self.logs = []
+        self.logs = ActivationLog(log_capacity, log_every, log_mode) if log else None
         self.log = log
         if log: print('logging')
 
@@ -21,15 +71,96 @@ class BnLayer(nn.Module):
             self.means = x_chan.mean(1)[:, None, None]
             self.stds = x_chan.std(1)[:, None, None]
         self.result = (x - self.means) / self.stds * self.m + self.a # for hook purposes
-        if self.log :
-            self.logs.append(self.result)
+        if self.log and self.training:  # validation batches would crowd out the training captures
+            self.logs(self.result)
         return self.result
 
 class ResnetLayer(BnLayer):
     def forward(self, x): return x + super().forward(x)
 
+
+class FastBnLayer(BnLayer):
+    """
+    `BnLayer` normalized by the fused `F.batch_norm` kernel instead of a transposed copy and separate mean/std passes.
+
+    Keeps running averages of the batch statistics (`momentum`) for eval, where `BnLayer` reuses the statistics of the
+    last training batch. Same `m` and `a` parameters as `BnLayer`; normalizes with the biased variance plus `eps`
+    instead of the unbiased std, which only differs for tiny batches.
+    """
+
+    def __init__(self, ni, nf, stride=2, kernel_size=3, log=False, momentum=0.1, eps=1e-5, **kwargs):
+        super().__init__(ni, nf, stride, kernel_size, log, **kwargs)
+        self.momentum, self.eps = momentum, eps
+        self.register_buffer('running_mean', torch.zeros(nf))
+        self.register_buffer('running_var', torch.ones(nf))
+
+    def forward(self, x):
+        x = F.relu(self.conv(x))
+        self.result = F.batch_norm(x, self.running_mean, self.running_var, self.m.view(-1), self.a.view(-1),
+                                   self.training, self.momentum, self.eps)
+        if self.log and self.training:
+            self.logs(self.result)
+        return self.result
+
+
+class FastResnetLayer(FastBnLayer):
+    def forward(self, x): return x + super().forward(x)
+
+
+class FoldedBnLayer(nn.Module):
+    """
+    Inference form of a `BnLayer` or `FastBnLayer`: conv, relu, then a per-channel affine holding the frozen
+    normalization folded into `m` and `a`. When every channel scale is positive the scale is moved into the conv
+    weights (relu commutes with it), leaving conv, relu and a single add.
+    """
+
+    def __init__(self, layer):
+        super().__init__()
+        if isinstance(layer, FastBnLayer):
+            mean, std = layer.running_mean, (layer.running_var + layer.eps).sqrt()
+        elif hasattr(layer, 'means'):
+            mean, std = layer.means.data.view(-1), layer.stds.data.view(-1)
+        else: raise ValueError('BnLayer has no batch statistics yet, run it in training mode first')
+        m, a = layer.m.data.view(-1), layer.a.data.view(-1)
+        scale, shift = m / std, a - mean * m / std  # on the device of the layer, like its conv
+        self.conv = copy.deepcopy(layer.conv)  # bias free, see BnLayer; export_inference places the copy
+        if (scale > 0).all():
+            self.conv.weight.data.mul_(scale.view(-1, 1, 1, 1))
+            self.scale = None
+        else: self.register_buffer('scale', scale.view(-1, 1, 1).clone())
+        self.register_buffer('shift', shift.view(-1, 1, 1).clone())
+
+    def forward(self, x):
+        x = F.relu(self.conv(x))
+        if self.scale is not None: x = x * self.scale
+        return x + self.shift
+
+
+class FoldedResnetLayer(FoldedBnLayer):
+    def forward(self, x): return x + super().forward(x)
+
+
+class InferenceResNet(nn.Module):
+    """ `ResNet` for inference only, as built by `ResNet.export_inference`: folded layers, no writer, no logs. """
+
+    def __init__(self, resnet):
+        super().__init__()
+        self.conv1, self.out = copy.deepcopy(resnet.conv1), copy.deepcopy(resnet.out)
+        self.layers = nn.ModuleList([FoldedBnLayer(l) for l in resnet.layers])
+        self.layers2 = nn.ModuleList([FoldedResnetLayer(l) for l in resnet.layers2])
+        self.layers3 = nn.ModuleList([FoldedResnetLayer(l) for l in resnet.layers3])
+
+    def forward(self, x):
+        x = self.conv1(x)
+        for l, l2, l3 in zip(self.layers, self.layers2, self.layers3):
+            x = l3(l2(l(x)))
+        x = F.adaptive_max_pool2d(x, 1)
+        x = x.view(x.size(0), -1)
+        return F.log_softmax(self.out(x), dim=-1)
+
 class ResNet(nn.Module):
-    def __init__(self, layers, num_classes, obj_name, exp_name="default", tb_log=True,):
+    def __init__(self, layers, num_classes, obj_name, exp_name="default", tb_log=True, log_capacity=32, log_every=1,
+                 log_mode='summary', fast_bn=False):
         """
 
         :param layers:
@@ -37,6 +168,8 @@ class ResNet(nn.Module):
         :param obj_name: like 'C', 'A'
         :param tb_log: boolean; if true then log to tensorboard
         :param exp_name: for example "v5_per_class" as in training on yeast_v5 with per class normalization
+        :param log_capacity, log_every, log_mode: activation capture of the last layer, see ActivationLog
+        :param fast_bn: use FastBnLayer (fused batch norm with running statistics) instead of BnLayer
         """
         self.arch = f"ResNet{len(layers)}"
         date = datetime.now().strftime("%m-%d_%H-%M")
@@ -49,13 +182,15 @@ class ResNet(nn.Module):
 
         super().__init__()
         self.conv1 = nn.Conv2d(2, 10, kernel_size=5, stride=1, padding=2)
-        self.layers = nn.ModuleList([BnLayer(layers[i], layers[i + 1])
+        bn_layer, resnet_layer = (FastBnLayer, FastResnetLayer) if fast_bn else (BnLayer, ResnetLayer)
+        self.layers = nn.ModuleList([bn_layer(layers[i], layers[i + 1])
                                      for i in range(len(layers) - 1)])
 
-        self.layers2 = nn.ModuleList([ResnetLayer(layers[i + 1], layers[i + 1], 1)
+        self.layers2 = nn.ModuleList([resnet_layer(layers[i + 1], layers[i + 1], 1)
                                       for i in range(len(layers) - 1)])
 
-        self.layers3 = nn.ModuleList([ResnetLayer(layers[i + 1], layers[i + 1], 1, log=(True if (i == (len(layers) - 2)) else False ))
+        self.layers3 = nn.ModuleList([resnet_layer(layers[i + 1], layers[i + 1], 1, log=(True if (i == (len(layers) - 2)) else False ),
+                                                  log_capacity=log_capacity, log_every=log_every, log_mode=log_mode)
                                       for i in range(len(layers) - 1)])
         self.out = nn.Linear(layers[-1], num_classes)
 
@@ -65,4 +200,25 @@ class ResNet(nn.Module):
             x = l3(l2(l(x)))
         x = F.adaptive_max_pool2d(x, 1)
         x = x.view(x.size(0), -1)
-        return F.log_softmax(self.out(x), dim=-1)
\ No newline at end of file
+        return F.log_softmax(self.out(x), dim=-1)
+
+    def log_activations(self):
+        """ Exports the captured activations to the tensorboard writer. """
+        if not hasattr(self, 'writer'): return
+        for name, module in self.named_modules():
+            if getattr(module, 'logs', None) is not None: module.logs.export(self.writer, f'activations/{name}')
+
+    def export_inference(self, example=None, cpu=True):
+        """
+        Lean copy of the model for batch scoring, see InferenceResNet. The frozen normalization of every layer is
+        folded into its affine (running statistics with fast_bn, else those of the last training batch).
+
+        :param example: optional input batch; if given, the copy is traced with torch.jit.trace
+        :param cpu: move the copy to the CPU
+        """
+        model = InferenceResNet(self).eval()  # built on the device of self, then moved as a whole
+        if cpu: model = model.cpu()
+        for p in model.parameters(): p.requires_grad = False
+        if example is None: return model
+        example = example.cpu() if cpu or not self.conv1.weight.is_cuda else example.cuda()
+        return torch.jit.trace(model, example)
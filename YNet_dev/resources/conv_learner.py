@@ -2,6 +2,7 @@ from .core import *
 from .layers import *
 from .learner import *
 from .initializers import *
+import hashlib, inspect, re
 
 model_meta = {
     resnet18: [8, 6], resnet34: [8, 6], resnet50: [8, 6], resnet101: [8, 6], resnet152: [8, 6],
@@ -13,6 +14,30 @@ model_meta = {
 model_features = {inception_4: 3072, dn121: 2048, dn161: 4416, }  # nasnetalarge: 4032*2}
 
 
+def fingerprint(o, h, seen=None):
+    """ (!) Feeds a stable description of o (transforms, stats, arrays, state dicts, ...) into the hash h.
+        Unlike repr, it leaves out object addresses and thread-local state. """
+    seen = set() if seen is None else seen
+    if isinstance(o, np.ndarray):
+        h.update(f'{o.dtype}{o.shape}'.encode())
+        h.update(np.ascontiguousarray(o).tobytes())
+    elif torch.is_tensor(o): fingerprint(o.cpu().numpy(), h, seen)
+    elif isinstance(o, (str, bytes, int, float, bool, type(None), np.generic)): h.update(repr(o).encode())
+    elif isinstance(o, (list, tuple)):
+        h.update(f'{type(o).__name__}{len(o)}'.encode())
+        for v in o: fingerprint(v, h, seen)
+    elif isinstance(o, dict):
+        for k in sorted(o, key=repr):
+            fingerprint(k, h, seen)
+            fingerprint(o[k], h, seen)
+    elif isinstance(o, type) or inspect.isroutine(o): h.update(o.__qualname__.encode())
+    else:
+        h.update(type(o).__qualname__.encode())
+        if hasattr(o, '__dict__') and id(o) not in seen:
+            seen.add(id(o))
+            fingerprint({k: v for k, v in vars(o).items() if not isinstance(v, threading.local)}, h, seen)
+
+
 class ConvnetBuilder():
     """Class representing a convolutional network.
 
@@ -138,8 +163,9 @@ class ConvLearner(Learner):
     def data(self):
         return self.fc_data if self.precompute else self.data_
 
-    def create_empty_bcolz(self, n, name):
-        return bcolz.carray(np.zeros((0, n), np.float32), chunklen=1, mode='w', rootdir=name)
+    def create_feature_file(self, n_rows, n, name):
+        """ (!) A `.npy` memory map of float32 activations, preallocated to the length of the dataset. """
+        return np.lib.format.open_memmap(name, mode='w+', dtype=np.float32, shape=(n_rows, n))
 
     def set_data(self, data, precompute=False):
         super().set_data(data)
@@ -161,25 +187,68 @@ class ConvLearner(Learner):
         self.precompute = precompute
         return res
 
+    def activation_key(self, dl, weights_key):
+        """ (!) Hash of what the activations of dl depend on: its files with their mtimes and sizes (or its arrays),
+            its transforms and the weights of the model. """
+        h = hashlib.sha1(weights_key.encode())
+        ds = dl.dataset
+        if hasattr(ds, 'fnames'):
+            for fn in ds.fnames:
+                st = os.stat(os.path.join(ds.path, fn))
+                h.update(f'{fn}\0{st.st_mtime_ns}\0{st.st_size}\n'.encode())
+        else: fingerprint(ds.x, h)
+        fingerprint(ds.transform, h)
+        return h.hexdigest()[:16]
+
+    def activation_path(self, split, key):
+        """ (!) Path of the activation array of split ('x_act', 'x_act_val' or 'x_act_test') under `activation_key` key;
+            its '.done' marker is this path + '.done'. """
+        return os.path.join(self.tmp_path, f'{split}_{self.models.name}_{self.data.sz}_{key}.npy')
+
+    def prune_activations(self, split, key):
+        """ (!) Removes the activation arrays (and markers) of split for this model and size under any other key. """
+        keep = os.path.basename(self.activation_path(split, key))
+        pattern = re.compile(re.escape(self.activation_path(split, '')[len(self.tmp_path) + 1:-len('.npy')])
+                             + r'[0-9a-f]{16}\.npy(\.done)?$')
+        for fn in os.listdir(self.tmp_path):
+            if pattern.match(fn) and fn not in (keep, keep + '.done'): os.remove(os.path.join(self.tmp_path, fn))
+
     def get_activations(self, force=False):
-        tmpl = f'_{self.models.name}_{self.data.sz}.bc'
-        # TODO: Somehow check that directory names haven't changed (e.g. added test set)
-        names = [os.path.join(self.tmp_path, p + tmpl) for p in ('x_act', 'x_act_val', 'x_act_test')]
-        if os.path.exists(names[0]) and not force:
-            self.activations = [bcolz.open(p) for p in names]
-        else:
-            self.activations = [self.create_empty_bcolz(self.models.nf, n) for n in names]
+        """ (!) Opens or creates the activation arrays of the (fixed) train, valid and test sets. Each is named by its
+            `activation_key`, so changed files, transforms or weights never reuse stale activations, and is only
+            reused once it was written completely (marked by a '.done' file). """
+        weights = hashlib.sha1()
+        fingerprint(self.models.top_model.state_dict(), weights)
+        self.activations, self.activation_keys = [], []
+        for p, dl in zip(('x_act', 'x_act_val', 'x_act_test'), (self.data.fix_dl, self.data.val_dl, self.data.test_dl)):
+            if dl is None:
+                self.activations.append(None)
+                self.activation_keys.append(None)
+                continue
+            key = self.activation_key(dl, weights.hexdigest())
+            name = self.activation_path(p, key)
+            done = name + '.done'
+            if os.path.exists(done) and not force:
+                self.activations.append(np.load(name, mmap_mode='r'))
+            else:
+                if os.path.exists(done): os.remove(done)
+                self.activations.append(self.create_feature_file(len(dl.dataset), self.models.nf, name))
+            self.activation_keys.append((p, key))
 
     def save_fc1(self):
         self.get_activations()
-        act, val_act, test_act = self.activations
         m = self.models.top_model
-        if len(self.activations[0]) != len(self.data.trn_ds):
-            predict_to_bcolz(m, self.data.fix_dl, act)
-        if len(self.activations[1]) != len(self.data.val_ds):
-            predict_to_bcolz(m, self.data.val_dl, val_act)
-        if self.data.test_dl and (len(self.activations[2]) != len(self.data.test_ds)):
-            if self.data.test_dl: predict_to_bcolz(m, self.data.test_dl, test_act)
+        dls = (self.data.fix_dl, self.data.val_dl, self.data.test_dl)
+        for i, (arr, dl, split_key) in enumerate(zip(self.activations, dls, self.activation_keys)):
+            if arr is None: continue
+            name = self.activation_path(*split_key)
+            if os.path.exists(name + '.done'): continue
+            n = predict_to_memmap(m, dl, arr)
+            if n != len(arr): raise ValueError(f'got {n} activations for {len(arr)} samples')
+            open(name + '.done', 'w').close()
+            self.prune_activations(*split_key)
+            self.activations[i] = np.load(name, mmap_mode='r')
+        act, val_act, test_act = self.activations
 
         self.fc_data = ImageClassifierData.from_arrays(self.data.path,
                                                        (act, self.data.trn_y), (val_act, self.data.val_y), self.data.bs,
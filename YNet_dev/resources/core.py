@@ -108,6 +108,14 @@ def SGD_Momentum(momentum):
 
 def one_hot(a,c): return np.eye(c)[a]
 
+def class_sample_weights(y, class_probs):
+    ''' (!) Per-sample weights under which the samples of class k are drawn with a total weight of class_probs[k].
+        Classes without samples get no weight. '''
+    y, class_probs = np.asarray(y), np.asarray(class_probs, dtype=np.float64)
+    occurrences = np.bincount(y, minlength=len(class_probs))[:len(class_probs)]
+    per_class = np.divide(class_probs, occurrences, out=np.zeros(len(class_probs)), where=occurrences > 0)
+    return per_class[y]
+
 def partition(a, sz): 
     """splits iterables a in equal parts of size sz"""
     return [a[i:i+sz] for i in range(0, len(a), sz)]
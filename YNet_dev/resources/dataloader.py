@@ -2,31 +2,229 @@ import torch, queue
 from torch.utils.data.sampler import SequentialSampler, RandomSampler, BatchSampler, WeightedRandomSampler
 from .imports import *
 from .core import *
-import collections,sys,traceback,threading
+import collections,sys,traceback,threading,warnings
+import ctypes, multiprocessing as mp
 from .core import *
 
 string_classes = (str, bytes)
 
 
-def get_tensor(batch, pin, half=False):
+def as_tensor(a, half=False, copy=True):
+    """ (!) Like `T(a, cuda=False)`, but a C-contiguous float32/float16 array that owns its memory (a fresh batch, not
+        a view into dataset storage such as a memory map or `ArraysDataset` rows) becomes a tensor sharing that memory
+        unless `copy` is set (e.g. for views into buffers that are reused). Other float16 arrays are copied. """
+    if not copy and not half and isinstance(a, np.ndarray) and a.dtype in (np.float32, np.float16) \
+            and a.flags.c_contiguous and a.flags.writeable and a.flags.owndata:
+        return torch.from_numpy(a)
+    if isinstance(a, np.ndarray) and a.dtype == np.float16: return torch.from_numpy(a.copy())  # T has no float16
+    return T(a, half=half, cuda=False).contiguous()
+
+
+def get_tensor(batch, pin, half=False, non_blocking=False, copy=True):
     if isinstance(batch, (np.ndarray, np.generic)):
-        batch = T(batch, half=half, cuda=False).contiguous()
+        batch = as_tensor(batch, half, copy)
         if pin: batch = batch.pin_memory()
-        return to_gpu(batch)
+        if not non_blocking: return to_gpu(batch)
+        return to_gpu(batch, non_blocking=True) if IS_TORCH_04 else to_gpu(batch, **{'async': True})
     elif isinstance(batch, string_classes):
         return batch
     elif isinstance(batch, collections.Mapping):
-        return {k: get_tensor(sample, pin, half) for k, sample in batch.items()}
+        return {k: get_tensor(sample, pin, half, non_blocking, copy) for k, sample in batch.items()}
     elif isinstance(batch, collections.Sequence):
-        return [get_tensor(sample, pin, half) for sample in batch]
+        return [get_tensor(sample, pin, half, non_blocking, copy) for sample in batch]
     raise TypeError(f"batch must contain numbers, dicts or lists; found {type(batch)}")
 
 
+def record_stream(batch, stream):
+    """ Marks the tensors of a batch as used on `stream`, so the caching allocator does not reuse them too early. """
+    if torch.is_tensor(batch):
+        if hasattr(batch, 'record_stream'): batch.record_stream(stream)
+    elif isinstance(batch, collections.Mapping):
+        for sample in batch.values(): record_stream(sample, stream)
+    elif isinstance(batch, collections.Sequence) and not isinstance(batch, string_classes):
+        for sample in batch: record_stream(sample, stream)
+
+
+class DevicePrefetcher:
+    """
+    Keeps up to `n` batches ready ahead of the consumer.
+
+    A background thread pulls numpy batches from `batches`, converts them to tensors and, with CUDA, pins them and
+    starts non-blocking host-to-device copies on a side stream. The consumer only waits for the copy of the batch it
+    takes, so the transfer of the next batches overlaps with the current training step. Without CUDA the thread still
+    overlaps collation and tensor conversion with the training step.
+    """
+
+    def __init__(self, batches, n=2, pin=False, half=False, copy=True):
+        self.batches, self.n, self.pin, self.half, self.copy = batches, n, pin, half, copy
+        self.stream = torch.cuda.Stream() if USE_GPU else None
+
+    def load(self, batch):
+        if self.stream is None: return get_tensor(batch, self.pin, self.half, copy=self.copy), None
+        with torch.cuda.stream(self.stream):
+            batch = get_tensor(batch, True, self.half, non_blocking=True, copy=self.copy)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return batch, event
+
+    def __iter__(self):
+        q, stop, done = queue.Queue(self.n), threading.Event(), object()
+
+        def put(item):
+            while not stop.is_set():
+                try: return q.put(item, timeout=0.1)
+                except queue.Full: pass
+
+        def produce():
+            try:
+                for batch in self.batches:
+                    if stop.is_set(): return
+                    put(self.load(batch))
+                put(done)
+            except Exception as e: put(e)
+            finally:
+                if hasattr(self.batches, 'close'): self.batches.close()  # e.g. stops multiprocess workers
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = q.get()
+                if item is done: break
+                if isinstance(item, Exception): raise item
+                batch, event = item
+                if event is not None:
+                    current = torch.cuda.current_stream()
+                    current.wait_event(event)
+                    record_stream(batch, current)
+                yield batch
+        finally:
+            stop.set()
+            producer.join()
+
+
+class SharedBatchRing:
+    """
+    Preallocated shared-memory slots for collated batches of the multiprocess `DataLoader`.
+
+    Each slot holds one buffer per batch field (e.g. x and y), sized for a full batch and laid out like the batch that
+    the ring was created from. Workers write collated batches straight into a slot; the main process reads them back as
+    numpy views, so no sample is copied through a pipe.
+    """
+
+    def __init__(self, batch, batch_size, n_slots):
+        if not all(isinstance(o, np.ndarray) for o in batch):
+            raise TypeError('multiprocess DataLoader needs batches made of numpy arrays')
+        self.layout = [((batch_size,) + o.shape[1:], o.dtype) for o in batch]
+        self.slots = [[mp.RawArray(ctypes.c_char, int(np.prod(shape)) * dtype.itemsize) for shape, dtype in self.layout]
+                      for _ in range(n_slots)]
+
+    def __len__(self): return len(self.slots)
+
+    def views(self, slot):
+        return [np.frombuffer(buf, dtype=dtype).reshape(shape) for buf, (shape, dtype) in zip(self.slots[slot], self.layout)]
+
+    def write(self, slot, batch):
+        for view, o in zip(self.views(slot), batch):
+            if o.shape[1:] != view.shape[1:]:
+                raise ValueError(f'batch field of shape {o.shape} does not fit a slot of shape {view.shape}')
+            if o.ctypes.data == view.ctypes.data and o.strides == view.strides: continue  # already written in place
+            view[:len(o)] = o
+        return len(batch[0])
+
+    def read(self, slot, n): return [view[:n] for view in self.views(slot)]
+
+
+WORKER_POLL = 5.  # (!) seconds between liveness checks of the worker processes while waiting for a batch
+
+
+def _process_worker(dl, ring, index_queue, result_queue, seed):
+    """ Worker loop of the multiprocess `DataLoader`: collates batches of indices into slots of the ring. """
+    random.seed(seed)
+    np.random.seed(seed % 2**32)
+    while True:
+        task = index_queue.get()
+        if task is None: break
+        batch_idx, slot, indices = task
+        try:
+            batch = dl.get_batch(indices, out=None if dl.transpose else ring.views(slot)[0])
+            result_queue.put((batch_idx, slot, ring.write(slot, batch), None))
+        except Exception:
+            result_queue.put((batch_idx, slot, 0, traceback.format_exc()))
+
+
+class ClassStratifiedSampler(object):
+    """
+    (!) Batch sampler that draws a class from the probability vector `class_probs`, then a random member of that class.
+
+    Members are drawn with replacement, so this samples the same distribution as a `WeightedRandomSampler` over
+    `class_sample_weights(ys, class_probs)`. The per-class index arrays are built once, though, so changing the class
+    mix with `set_class_probs` only replaces a vector of num_classes values instead of rebuilding a weight per sample.
+
+    quotas: instead of drawing every class independently, each batch gets floor(batch_size * p) samples of every
+        class, and only the remaining slots are drawn (in proportion to the rounded-off fractions). Every batch then
+        holds its share of each class, and the expected counts are the same as without quotas.
+    """
+
+    def __init__(self, ys, batch_size, class_probs=None, quotas=False, drop_last=False, num_samples=None):
+        ys = np.asarray(ys).astype(np.int64)
+        self.batch_size, self.quotas, self.drop_last = batch_size, quotas, drop_last
+        self.num_samples = len(ys) if num_samples is None else num_samples
+        self.counts = np.bincount(ys)
+        self.members = np.argsort(ys, kind='mergesort')  # sample indices grouped by class
+        self.starts = np.cumsum(self.counts) - self.counts
+        self.set_class_probs(self.counts if class_probs is None else class_probs)
+
+    def set_class_probs(self, class_probs):
+        """ Sets the class mix of the coming batches; class_probs need not sum to one, classes without samples are
+            never drawn. O(num_classes). """
+        p = np.zeros(len(self.counts))
+        class_probs = np.asarray(class_probs, dtype=np.float64)[:len(p)]
+        p[:len(class_probs)] = class_probs
+        p[self.counts == 0] = 0
+        if p.sum() <= 0: raise ValueError('class_probs gives no weight to any class with samples')
+        self.class_probs = p / p.sum()
+
+    def batch_sizes(self):
+        n_full, last = divmod(self.num_samples, self.batch_size)
+        return [self.batch_size] * n_full + ([last] if last and not self.drop_last else [])
+
+    def __len__(self): return len(self.batch_sizes())
+
+    def draw_classes(self, n):
+        """ Classes of a batch of n samples, see `quotas` """
+        if not self.quotas: return np.random.choice(len(self.class_probs), n, p=self.class_probs)
+        expected = n * self.class_probs
+        counts = np.floor(expected).astype(np.int64)
+        rest = n - counts.sum()
+        if rest: counts += np.random.multinomial(rest, (expected - counts) / (expected - counts).sum())
+        return np.random.permutation(np.repeat(np.arange(len(counts)), counts))
+
+    def __iter__(self):
+        sizes = self.batch_sizes()
+        if self.quotas: classes = np.concatenate([self.draw_classes(n) for n in sizes]) if sizes else np.zeros(0, int)
+        else: classes = self.draw_classes(sum(sizes))
+        picks = self.starts[classes] + (np.random.random_sample(len(classes)) * self.counts[classes]).astype(np.int64)
+        idxs = self.members[picks]
+        for end, n in zip(np.cumsum(sizes), sizes): yield idxs[end - n:end].tolist()
+
+
 class DataLoader(object):
     def __init__(self, dataset, batch_size=1, shuffle=False, sampler=None, batch_sampler=None, pad_idx=0,
                  num_workers=None, pin_memory=False, drop_last=False, pre_pad=True, half=False, weights=None,
-                 transpose=False, transpose_y=False):
+                 transpose=False, transpose_y=False, multiprocess=False, prefetch=0, class_probs=None, quotas=False):
+        """
+        class_probs: opt-in; batches are drawn by a `ClassStratifiedSampler` with this class mix (e.g. the sample count
+            of each class for the natural frequencies), which `set_class_probs` changes in O(num_classes).
+        quotas: give every batch its share of each class, see `ClassStratifiedSampler`; needs class_probs.
+        multiprocess: opt-in; batches are collated by `num_workers` forked processes into a ring of shared-memory
+            slots instead of a thread pool. Sampling stays in the main process, so `weights`, `set_dynamic_sampler`
+            and `reset_sampler` behave the same. Needs batches made of numpy arrays and the 'fork' start method.
+        prefetch: number of batches a `DevicePrefetcher` keeps converted (and, with CUDA, copied to the device)
+            ahead of the consumer; 0 converts each batch when it is requested.
+        """
         self.dataset, self.batch_size, self.num_workers = dataset, batch_size, num_workers
+        self.multiprocess, self.prefetch = multiprocess, prefetch
         self.pin_memory, self.drop_last, self.pre_pad = pin_memory, drop_last, pre_pad
         self.transpose, self.transpose_y, self.pad_idx, self.half = transpose, transpose_y, pad_idx, half
         
@@ -44,7 +242,10 @@ class DataLoader(object):
                 sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
             if weights is not None:  # (!)
                 sampler = WeightedRandomSampler(weights, len(weights))
-            batch_sampler = BatchSampler(sampler, batch_size, drop_last)
+            if class_probs is not None:  # (!)
+                batch_sampler = ClassStratifiedSampler(dataset.labels(), batch_size, class_probs, quotas, drop_last)
+            else:
+                batch_sampler = BatchSampler(sampler, batch_size, drop_last)
 
         if num_workers is None:
             self.num_workers = num_cpus()
@@ -54,11 +255,18 @@ class DataLoader(object):
         self.sampler = sampler
         self.batch_sampler = batch_sampler
         self.weights = weights # (!) 
+        self.class_probs, self.quotas = class_probs, quotas  # (!)
 
     def __len__(self):
         return len(self.batch_sampler)
 
+    @property
+    def stratified(self): return isinstance(self.batch_sampler, ClassStratifiedSampler)
+
     def reset_sampler(self): #(!) self.weights serves as proxy for whether original dataloader was defined with balance = True
+        if self.class_probs is not None:
+            self.set_class_probs(self.class_probs)  # (!) O(num_classes) while the sampler is stratified
+            return
         if self.weights is not None:
             self.sampler = WeightedRandomSampler(self.weights, len(self.weights))
         else:
@@ -70,6 +278,21 @@ class DataLoader(object):
         self.sampler = WeightedRandomSampler(weights, len(weights))
         self.batch_sampler = BatchSampler(self.sampler, batch_size, self.drop_last)
 
+    def set_class_probs(self, class_probs):  # (!)
+        """ Draws the coming batches with the class mix class_probs, see `ClassStratifiedSampler`. Only the first call
+            on a loader without a stratified sampler looks at the labels; that call replaces its sampler (and any
+            per-sample weights) until `reset_sampler` restores the one the loader was built with. """
+        if self.stratified: self.batch_sampler.set_class_probs(class_probs)
+        else:
+            if self.weights is not None:
+                warnings.warn('set_class_probs replaces the per-sample weights of this DataLoader until reset_sampler')
+            self.batch_sampler = ClassStratifiedSampler(self.dataset.labels(), self.batch_size, class_probs, self.quotas,
+                                                        self.drop_last)
+
+    def class_counts(self):  # (!)
+        """ Number of samples per class index, without looking at the labels when the sampler is stratified """
+        return self.batch_sampler.counts if self.stratified else self.dataset.class_counts()
+
 
     def jag_stack(self, b):
         if len(b[0].shape) not in (1, 2): return np.stack(b)
@@ -98,19 +321,78 @@ class DataLoader(object):
             return [self.np_collate(samples) for samples in zip(*batch)]
         raise TypeError(("batch must contain numbers, dicts or lists; found {}".format(type(b))))
 
-    def get_batch(self, indices):
-        res = self.np_collate([self.dataset[i] for i in indices])
+    def get_batch(self, indices, out=None):
+        """ out: optional preallocated buffer for x, which a final `FusedNormalize` batch stage fills in place. """
+        tfm = getattr(self.dataset, 'transform', None)
+        if tfm is None and hasattr(self.dataset, 'get_batch'):
+            res = self.dataset.get_batch(indices)  # (!) whole-batch reads, e.g. PackedArrayDataset
+        elif getattr(tfm, 'batch_mode', False) and not tfm.sample_tfms and hasattr(self.dataset, 'get_image_batch'):
+            res = tfm.batch_call(*self.dataset.get_image_batch(indices), out=out)  # (!) no per-sample stage to run
+        else:
+            res = self.np_collate([self.dataset[i] for i in indices])
+            if getattr(tfm, 'batch_mode', False): res = tfm.batch_call(*res, out=out)  # (!) batched augmentation stage
         if self.transpose:   res[0] = res[0].T
         if self.transpose_y: res[1] = res[1].T
         return res
 
-    def __iter__(self):
-        if self.num_workers == 0:
-            for batch in map(self.get_batch, iter(self.batch_sampler)):  # (!) map(self.get_batch, iter(self.)); we need a dynamic weights varibale passed in
-                yield get_tensor(batch, self.pin_memory, self.half)
+    def iter_processes(self):
+        batches = iter(self.batch_sampler)
+        try: first = self.get_batch(next(batches))  # also gives the layout of the shared slots
+        except StopIteration: return
+        ring = SharedBatchRing(first, self.batch_size, self.num_workers * 2)
+        yield first
+
+        ctx = mp.get_context('fork')
+        index_queue, result_queue = ctx.Queue(), ctx.Queue()
+        seed = random.randrange(2**31)
+        workers = [ctx.Process(target=_process_worker, args=(self, ring, index_queue, result_queue, seed + i), daemon=True)
+                   for i in range(self.num_workers)]
+        for w in workers: w.start()
+
+        free, ready = list(range(len(ring))), {}
+        n_sent, n_done = 1, 1
+        try:
+            while True:
+                while free:  # keep every free slot busy, the ring bounds the batches in flight
+                    indices = next(batches, None)
+                    if indices is None: break
+                    index_queue.put((n_sent, free.pop(), indices))
+                    n_sent += 1
+                if n_done == n_sent: break
+                while n_done not in ready:
+                    try: batch_idx, slot, n, err = result_queue.get(timeout=WORKER_POLL)
+                    except queue.Empty:  # a killed worker (OOM, segfault) never answers, don't wait on it forever
+                        dead = [w for w in workers if not w.is_alive()]
+                        if dead: raise RuntimeError(f'DataLoader worker (pid {dead[0].pid}) exited unexpectedly '
+                                                    f'with exit code {dead[0].exitcode}')
+                        continue
+                    if err is not None: raise RuntimeError(f'DataLoader worker failed:\n{err}')
+                    ready[batch_idx] = (slot, n)
+                slot, n = ready.pop(n_done)
+                yield ring.read(slot, n)  # views into the slot, which is reused once the consumer asks for more
+                free.append(slot)
+                n_done += 1
+        finally:
+            for w in workers: w.terminate()
+            for w in workers: w.join()
+
+    def iter_batches(self):
+        """ Collated numpy batches, before conversion to tensors. """
+        if self.num_workers and self.multiprocess:
+            yield from self.iter_processes()
+        elif self.num_workers == 0:
+            yield from map(self.get_batch, iter(self.batch_sampler))  # (!) map(self.get_batch, iter(self.)); we need a dynamic weights varibale passed in
         else:
             with ThreadPoolExecutor(max_workers=self.num_workers) as e:
                 # avoid py3.6 issue where queue is infinite and can result in memory exhaustion
                 for c in chunk_iter(iter(self.batch_sampler), self.num_workers * 10):
-                    for batch in e.map(self.get_batch, c):
-                        yield get_tensor(batch, self.pin_memory, self.half)
+                    yield from e.map(self.get_batch, c)
+
+    def __iter__(self):
+        # batches are fresh arrays that can back their tensors, except views into the reused multiprocess slots
+        copy = bool(self.num_workers and self.multiprocess)
+        if self.prefetch:
+            yield from DevicePrefetcher(self.iter_batches(), self.prefetch, self.pin_memory, self.half, copy)
+        else:
+            for batch in self.iter_batches():
+                yield get_tensor(batch, self.pin_memory, self.half, copy=copy)
@@ -8,9 +8,7 @@ from .dataloader import DataLoader
 from collections import Counter
 
 # (!) added imports to allow open_image to function with skimage.io.imread(), file-extension agnostic.
-from skimage.external import tifffile
-# (!) added for debug
-import matplotlib.pyplot as plt
+tifffile = LazyModule('skimage.external.tifffile')
 
 
 def get_cv_idxs(n, cv_idx=0, val_pct=0.2, seed=42):
@@ -87,6 +85,54 @@ def read_dirs(path, folder):
     return fnames, lbls, all_lbls
 
 
+def scan_dirs(path, folder, manifest=None):
+    """
+    (!) `read_dirs` through a manifest, for slow (networked) storage.
+
+    The label folders are listed in parallel with `os.scandir` and the result is saved as a manifest,
+    `<path>/tmp/<folder>.dirs.npz` by default, together with the mtimes of `folder` and its label folders. Later calls
+    only stat those folders and reuse the manifest while none of the mtimes changed, i.e. no files were added, removed
+    or renamed. Files are listed in name order.
+
+    Returns:
+    -------
+    fnames, lbls, all_lbls: as returned by `read_dirs`
+    """
+    full_path = os.path.join(path, folder)
+    manifest = manifest or os.path.join(path, 'tmp', f'{folder}.dirs.npz')
+    if os.path.exists(manifest):
+        m = np.load(manifest)
+        all_lbls = [str(o) for o in m['all_lbls']]
+        try: mtimes = [os.stat(o).st_mtime_ns for o in [full_path] + [os.path.join(full_path, l) for l in all_lbls]]
+        except FileNotFoundError: mtimes = None
+        if mtimes is not None and np.array_equal(mtimes, m['mtimes']):
+            return [str(o) for o in m['fnames']], [str(o) for o in m['lbls']], all_lbls
+
+    root_mtime = os.stat(full_path).st_mtime_ns  # before listing, so changes made during the scan invalidate it
+    all_lbls = sorted(o.name for o in os.scandir(full_path)
+                      if o.is_dir() and o.name not in ('.ipynb_checkpoints', '.DS_Store'))
+
+    def scan(lbl):
+        lbl_path = os.path.join(full_path, lbl)
+        mtime = os.stat(lbl_path).st_mtime_ns
+        with os.scandir(lbl_path) as it:
+            return mtime, sorted(o.name for o in it if o.name != '.DS_Store' and not o.is_dir())
+
+    with ThreadPoolExecutor(num_cpus()) as e: listings = list(e.map(scan, all_lbls))
+
+    fnames, lbls = [], []
+    for lbl, (_, names) in zip(all_lbls, listings):
+        fnames += [os.path.join(folder, lbl, fname) for fname in names]
+        lbls += [lbl] * len(names)
+
+    os.makedirs(os.path.dirname(manifest), exist_ok=True)
+    with open(manifest + '.tmp', 'wb') as f:
+        np.savez(f, fnames=np.array(fnames, dtype=str), lbls=np.array(lbls, dtype=str),
+                 all_lbls=np.array(all_lbls, dtype=str), mtimes=np.array([root_mtime] + [o[0] for o in listings]))
+    os.replace(manifest + '.tmp', manifest)
+    return fnames, lbls, all_lbls
+
+
 def n_hot(ids, c):
     '''
     one hot encoding by index. Returns array of length c, where all entries are 0, except for the indecies in ids
@@ -96,10 +142,11 @@ def n_hot(ids, c):
     return res
 
 
-def folder_source(path, folder, d):
+def folder_source(path, folder, d, manifest=False):
     """
     Returns the filenames and labels for a folder within a path
     (!) Modified to accomodate multiple source folders for a single class e.g. WT from Experiment 01 and 02
+    (!) manifest: True (default location) or the path of a cached directory listing to reuse, see `scan_dirs`
 
     Returns:
     -------
@@ -110,8 +157,25 @@ def folder_source(path, folder, d):
     all_lbls: a list of all of the labels in `folder`, where the # of labels is determined by the # of directories within `folder`
     
     """
-    fnames, lbls, all_lbls = read_dirs(path, folder)
-    
+    if manifest: fnames, lbls, all_lbls = scan_dirs(path, folder, None if manifest is True else manifest)
+    else: fnames, lbls, all_lbls = read_dirs(path, folder)
+    cls_idx_arr, u_classes, src_idx_arr = label_arrays(lbls, all_lbls, d)
+    return fnames, cls_idx_arr, u_classes, src_idx_arr, all_lbls
+
+
+def label_arrays(lbls, all_lbls, d):
+    """
+    (!) The label bookkeeping of `folder_source`, for file lists that were not read from a folder (e.g. zip members)
+
+    Arguments:
+    lbls: the label (folder name) of every file
+    all_lbls: all of the labels, sorted like the folders in `read_dirs`
+    d: label dictionary shared between splits, populated if empty
+
+    Returns:
+    -------
+    cls_idx_arr, u_classes, src_idx_arr: as returned by `folder_source`
+    """
     lbls2classes = {l: l.split('_')[1] for l in all_lbls} # (!) dict mapping lbls (folders) to classes (genotype)
     u_classes = list(dict.fromkeys(list(lbls2classes.values()))) # (!) get unique classes
     
@@ -132,7 +196,7 @@ def folder_source(path, folder, d):
     # temp = [idxs.index(i) for i in range(len(all_lbls))]
     # for ii in temp: print(f"{idxs[ii]} maps to {fnames[ii]}")
     
-    return fnames, cls_idx_arr, u_classes, src_idx_arr, all_lbls
+    return cls_idx_arr, u_classes, src_idx_arr
 
 def parse_csv_labels(fn, skip_header=True, cat_separator=' '):
     """Parse filenames and label sets from a CSV file.
@@ -244,6 +308,21 @@ class BaseDataset(Dataset):
         """Return i-th label."""
         raise NotImplementedError
 
+    def get_src_idx(self, i): return None  # (!) src_idx
+
+    def labels(self):
+        """(!) Labels of all samples, without loading or transforming any of them."""
+        return np.array([self.get_y(i) for i in range(self.n)])
+
+    def src_indices(self):
+        """(!) Source folder index of all samples, or None if the dataset has none."""
+        src_idx = [self.get_src_idx(i) for i in range(self.n)]
+        return None if any(o is None for o in src_idx) else np.array(src_idx)
+
+    def class_counts(self):
+        """(!) Number of samples per class index."""
+        return np.bincount(self.labels(), minlength=self.c)
+
     @property
     def is_multi(self):
         """Returns true if this data set contains multiple labels per sample."""
@@ -333,6 +412,10 @@ class FilesArrayDataset(FilesDataset):
 
     def get_src_idx(self, i): return self.src_idx[i] if self.src_idx is not None else None #(!) src_idx get method
 
+    def labels(self): return np.asarray(self.y)
+
+    def src_indices(self): return None if self.src_idx is None else np.asarray(self.src_idx)
+
     def get_c(self):
         return self.y.shape[1] if len(self.y.shape) > 1 else 0
 
@@ -359,6 +442,10 @@ class ArraysDataset(BaseDataset):
 
     def get_src_idx(self, i): return self.src_idx[i] if self.src_idx is not None else None #(!) src_idx get method
 
+    def labels(self): return np.asarray(self.y)
+
+    def src_indices(self): return None if self.src_idx is None else np.asarray(self.src_idx)
+
     def get_x(self, i): return self.x[i]
 
     def get_y(self, i): return self.y[i]
@@ -367,6 +454,21 @@ class ArraysDataset(BaseDataset):
 
     def get_sz(self): return self.x.shape[1]
 
+    def read_rows(self, idxs, dtype=None):
+        """ (!) Rows idxs of x; a contiguous run is a slice (no copy for a memory map), other runs are read in order. """
+        idxs = np.asarray(idxs)
+        if len(idxs) > 1 and np.all(np.diff(idxs) == 1):
+            xs = self.x[idxs[0]:idxs[-1] + 1]
+            return xs if dtype is None else xs.astype(dtype)
+        order = np.argsort(idxs)  # read a memory map front to back
+        xs = np.empty((len(idxs),) + self.x.shape[1:], dtype=dtype or self.x.dtype)
+        xs[order] = self.x[idxs[order]]
+        return xs
+
+    def get_batch(self, idxs):
+        """ (!) Whole batches for the `DataLoader` when there is no transform, e.g. precomputed activations. """
+        return [self.read_rows(idxs), self.y[np.asarray(idxs)]]
+
 
 class ArraysIndexDataset(ArraysDataset):
     def get_c(self): return int(self.y.max()) + 1
@@ -381,6 +483,123 @@ class ArraysNhotDataset(ArraysDataset):
     def is_multi(self): return True
 
 
+def pack_folder(path, folder, d, dest=None):
+    """ One-time conversion of a `folder_source` style folder of 16-bit TIFF stacks into a packed array store.
+
+    Every image is decoded once and written into a single uint16 memory-mapped array of shape (N, C, H, W),
+    `<dest>/<folder>.x.npy`. Labels, source indices and file names are written next to it as a sidecar,
+    `<dest>/<folder>.meta.npz`, so the split can be loaded again with `load_packed` without touching the TIFFs.
+
+    Arguments:
+        path: root path of the data, as passed to `folder_source`
+        folder: name of the split folder, e.g. 'train'
+        d: label dictionary shared between splits, populated like in `folder_source`
+        dest: directory of the packed store, defaults to `<path>/packed`
+
+    Returns:
+        the `folder_source` tuple of the packed split, with the file names replaced by the memory-mapped array
+    """
+    dest = dest or os.path.join(path, 'packed')
+    os.makedirs(dest, exist_ok=True)
+    fnames, cls_idx_arr, u_classes, src_idx_arr, all_lbls = folder_source(path, folder, d)
+    first = tifffile.imread(os.path.join(path, fnames[0]))
+    if first.dtype != np.uint16: raise ValueError(f'Expected 16-bit images, found {first.dtype} at: {fnames[0]}')
+
+    x = np.lib.format.open_memmap(os.path.join(dest, f'{folder}.x.npy'), mode='w+', dtype=np.uint16,
+                                  shape=(len(fnames),) + first.shape)
+
+    def fill(i):
+        im = tifffile.imread(os.path.join(path, fnames[i]))
+        if im.shape != first.shape:
+            raise ValueError(f'Expected shape {first.shape}, found {im.shape} at: {fnames[i]}')
+        x[i] = im
+
+    with ThreadPoolExecutor(num_cpus()) as e:
+        for _ in tqdm(e.map(fill, range(len(fnames))), total=len(fnames), desc=folder, leave=False): pass
+    x.flush()
+    del x
+
+    save_packed_meta(dest, folder, fnames, cls_idx_arr, u_classes, src_idx_arr, all_lbls, d)
+    return load_packed(dest, folder)
+
+
+def save_packed_meta(dest, folder, fnames, cls_idx_arr, u_classes, src_idx_arr, all_lbls, d):
+    """ Writes the `<dest>/<folder>.meta.npz` sidecar of a packed split, see `pack_folder` """
+    np.savez(os.path.join(dest, f'{folder}.meta.npz'), y=cls_idx_arr, src_idx=src_idx_arr, fnames=np.array(fnames),
+             classes=np.array(u_classes), all_lbls=np.array(all_lbls), lbl2index=np.array(json.dumps(d)))
+
+
+def pack_from_path(path, trn_name='train', val_name='valid', test_name=None, dest=None):
+    """ Packs the train, validation and (optionally) labelled test folders of `path`, see `pack_folder`.
+
+    Returns:
+        lbl2index, test_lbl2index: the label dictionaries, as returned by `ImageClassifierData.prepare_from_path`
+    """
+    lbl2index, test_lbl2index = {}, {}
+    for folder in (trn_name, val_name): pack_folder(path, folder, lbl2index, dest)
+    if test_name: pack_folder(path, test_name, test_lbl2index, dest)
+    return lbl2index, test_lbl2index
+
+
+def load_packed(dest, folder):
+    """ Opens a split written by `pack_folder`.
+
+    Returns:
+        x: read-only memory-mapped uint16 array of shape (N, C, H, W)
+        cls_idx_arr, u_classes, src_idx_arr, all_lbls: as returned by `folder_source`
+    """
+    x = np.load(os.path.join(dest, f'{folder}.x.npy'), mmap_mode='r')
+    meta = np.load(os.path.join(dest, f'{folder}.meta.npz'))
+    return x, meta['y'], list(meta['classes']), meta['src_idx'], list(meta['all_lbls'])
+
+
+def load_packed_index(dest, folder):
+    """ Returns the label dictionary `d` that was used when `folder` was packed. """
+    meta = np.load(os.path.join(dest, f'{folder}.meta.npz'))
+    return json.loads(str(meta['lbl2index']))
+
+
+class PackedArrayDataset(ArraysIndexDataset):
+    """ A dataset reading from a packed uint16 (N, C, H, W) array, see `pack_folder`.
+
+    Samples are float32 arrays scaled to 0.0 - 1.0. With a transform they are (H, W, C) like `open_image` returns
+    them, so the usual `Transforms` apply; without one they keep the stored (C, H, W) layout, the same as the whole
+    (N, C, H, W) batches that `get_batch` hands the `DataLoader`, sliced from the memory map and converted to float
+    once per batch. With a `batch_mode` transform whose whole pipeline is batchable, `get_image_batch` does the same
+    for its batch stage; any per-sample transform (e.g. `RandomRotate`) makes the `DataLoader` fall back to reading
+    and transforming sample by sample.
+    """
+
+    def __init__(self, x, y, transform, src_idx, norm_value=65535):
+        self.norm_value = norm_value
+        super().__init__(x, y, transform, src_idx)
+
+    def get_x(self, i):
+        im = self.x[i] if self.transform is None else np.moveaxis(self.x[i], 0, -1)
+        im = im.astype(np.float32)
+        return np.divide(im, self.norm_value, out=im)
+
+    def get_sz(self): return self.x.shape[-1]
+
+    def get_batch(self, idxs):
+        xs = self.read_rows(idxs, np.float32)
+        return [np.divide(xs, self.norm_value, out=xs), self.y[np.asarray(idxs)]]
+
+    def get_image_batch(self, idxs):
+        """ (!) Samples idxs as a transform receives them, collated: (N, H, W, C) images (a view of one float copy of
+            the rows), labels and source indices, -1 where there is none. """
+        idxs = np.asarray(idxs)
+        xs, ys = self.get_batch(idxs)
+        src_idx = np.full(len(idxs), -1) if self.src_idx is None else np.asarray(self.src_idx)[idxs]
+        return np.moveaxis(xs, 1, -1), ys, src_idx
+
+    def denorm(self, arr, y=None, src_idx=None):
+        """Reverse the normalization done to a batch of images, see `FilesDataset.denorm`."""
+        if type(arr) is not np.ndarray: arr = to_np(arr)
+        if len(arr.shape) == 3: arr = arr[None]
+        return self.transform.denorm(np.rollaxis(arr, 1, 4), y, src_idx)
+
+
 class ModelData():
     def __init__(self, path, trn_dl, val_dl, test_dl=None):
         self.path, self.trn_dl, self.val_dl, self.test_dl = path, trn_dl, val_dl, test_dl
@@ -414,9 +633,12 @@ class ModelData():
 
 
 class ImageData(ModelData):
-    def __init__(self, path, datasets, bs, num_workers, classes, balance=None): # (!) balance
+    def __init__(self, path, datasets, bs, num_workers, classes, balance=None, multiprocess=False,
+                 prefetch=0, class_probs=None, quotas=False): # (!) balance, class_probs
         trn_ds, val_ds, fix_ds, aug_ds, test_ds, test_aug_ds = datasets
         self.path, self.bs, self.num_workers, self.classes = path, bs, num_workers, classes
+        self.multiprocess, self.prefetch = multiprocess, prefetch
+        self.class_probs, self.quotas = class_probs, quotas  # (!) class-stratified sampling of trn_dl, see DataLoader
         self.trn_dl, self.val_dl, self.fix_dl, self.aug_dl, self.test_dl, self.test_aug_dl = [
             self.get_dl(ds, shuf, weights) for ds, shuf, weights in [ # (!) weights
                 (trn_ds, True, balance), (val_ds, False, None), (fix_ds, False, None), (aug_ds, False,None),
@@ -426,8 +648,11 @@ class ImageData(ModelData):
 
     def get_dl(self, ds, shuffle, weights):
         if ds is None: return None
+        stratified = shuffle and self.class_probs is not None  # (!) only the training set
         return DataLoader(ds, batch_size=self.bs, shuffle=shuffle, weights=weights,
-                          num_workers=self.num_workers, pin_memory=False)
+                          num_workers=self.num_workers, pin_memory=False, multiprocess=self.multiprocess,
+                          prefetch=self.prefetch, class_probs=self.class_probs if stratified else None,
+                          quotas=self.quotas and stratified)
 
     @property
     def sz(self):
@@ -523,6 +748,9 @@ class ImageClassifierData(ImageData):
             num_workers: a number of workers
             test: a matrix of test data (the shape should match `trn[0]`)
 
+            (!) the matrices may be memory maps, e.g. `np.load(fn, mmap_mode='r')`; without tfms, batches are sliced
+            straight from them.
+
         Returns:
             ImageClassifierData
         """
@@ -531,7 +759,8 @@ class ImageClassifierData(ImageData):
 
     @classmethod
     def prepare_from_path(cls, path, bs=64, trn_name='train', val_name='valid', test_name=None, test_with_labels=False,
-                          num_workers=8, balance=False):
+                          num_workers=8, balance=False, multiprocess=False, prefetch=0, manifest=False,
+                          stratified=False, quotas=False):
         """ Read in images and their labels given as sub-folder names
 
         Arguments:
@@ -542,6 +771,12 @@ class ImageClassifierData(ImageData):
             val_name:  a name of the folder that contains validation images.
             test_name:  a name of the folder that contains test images.
             num_workers: number of workers
+            multiprocess: collate batches in worker processes instead of threads, see `DataLoader`
+            prefetch: number of batches to keep ready on the device ahead of training, see `DataLoader`
+            manifest: reuse cached listings of the label folders while they are unchanged, see `scan_dirs`
+            stratified: sample training batches class-then-member with a `ClassStratifiedSampler` (equal classes with
+                balance, the natural frequencies otherwise), so `fit(adjust_class=...)` only updates the class mix
+            quotas: give every training batch its share of each class; implies stratified
 
         Returns:
             ImageClassifierData
@@ -549,19 +784,59 @@ class ImageClassifierData(ImageData):
         lbl2index = {}  # gets populated in the folder_source calls
         test_lbl2index = {}
 
-        trn, val = [folder_source(path, o, lbl2index) for o in (trn_name, val_name)]
-        if balance:
-            weights = compute_adjusted_weights(trn)
-        else:
-            weights = None
+        trn, val = [folder_source(path, o, lbl2index, manifest=manifest) for o in (trn_name, val_name)]
+        weights, class_probs = stratified_balance(trn, balance, stratified or quotas)
 
         if test_name:
-            test = folder_source(path, test_name, test_lbl2index) if test_with_labels else read_dir(path, test_name)
+            test = (folder_source(path, test_name, test_lbl2index, manifest=manifest) if test_with_labels
+                    else read_dir(path, test_name))
         else:
             test = None
         def create(tfms):
             datasets = cls.get_ds(FilesIndexArrayDataset, trn, val, tfms, path=path, test=test)
-            return cls(path, datasets, bs, num_workers, classes=trn[2], balance=weights)
+            return cls(path, datasets, bs, num_workers, classes=trn[2], balance=weights, multiprocess=multiprocess,
+                       prefetch=prefetch, class_probs=class_probs, quotas=quotas)
+
+        return create, lbl2index, test_lbl2index
+
+    @classmethod
+    def prepare_from_packed(cls, path, bs=64, trn_name='train', val_name='valid', test_name=None, num_workers=8,
+                            balance=False, dest=None, multiprocess=False, prefetch=0, stratified=False, quotas=False,
+                            batch_mode=False):
+        """ Like `prepare_from_path`, but reads the packed array store written by `pack_from_path`
+
+        Arguments:
+            path: a root path of the data (used for storing trained models, precomputed values, etc)
+            bs: batch size
+            trn_name: a name of the folder that contains training images.
+            val_name:  a name of the folder that contains validation images.
+            test_name:  a name of the folder that contains (labelled) test images.
+            num_workers: number of workers
+            dest: directory of the packed store, defaults to `<path>/packed`
+            multiprocess: collate batches in worker processes instead of threads, see `DataLoader`
+            prefetch: number of batches to keep ready on the device ahead of training, see `DataLoader`
+            batch_mode: require transforms that run entirely per batch (`Transforms(batch_mode=True)` with only
+                batchable transforms), so every batch is read from the packed array in one slice
+
+        Returns:
+            create, lbl2index, test_lbl2index: as returned by `prepare_from_path`
+        """
+        dest = dest or os.path.join(path, 'packed')
+        trn, val = [load_packed(dest, o) for o in (trn_name, val_name)]
+        lbl2index = load_packed_index(dest, trn_name)
+        weights, class_probs = stratified_balance(trn, balance, stratified or quotas)
+
+        if test_name:
+            test, test_lbl2index = load_packed(dest, test_name), load_packed_index(dest, test_name)
+        else:
+            test, test_lbl2index = None, {}
+
+        def create(tfms):
+            if batch_mode and not all(getattr(t, 'batch_mode', False) and not t.sample_tfms for t in tfms):
+                raise ValueError('batch_mode needs transforms without per-sample stages, see Transforms(batch_mode=True)')
+            datasets = cls.get_ds(PackedArrayDataset, trn, val, tfms, test=test)
+            return cls(path, datasets, bs, num_workers, classes=trn[2], balance=weights, multiprocess=multiprocess,
+                       prefetch=prefetch, class_probs=class_probs, quotas=quotas)
 
         return create, lbl2index, test_lbl2index
 
@@ -635,15 +910,8 @@ def compute_default_weights(dataset):
     :param dataset: dataset[0]: samples and names e.g. generic_filename; dataset[1] labels e.g. 0 or 1
     :return: set of weights/probabilities for each sample; represents how often it is picked
     """
-    weights = np.zeros(len(dataset[1]))
-    labels = list(set(dataset[1]))
     occurrences = np.bincount(dataset[1])
-    probs = [100 * count/sum(occurrences) for count in occurrences]
-
-    for idx, label in enumerate(labels):
-        weights[dataset[1] == label] = probs[idx] / occurrences[idx]
-
-    return weights
+    return class_sample_weights(dataset[1], 100 * occurrences / occurrences.sum())
 
 
 def compute_adjusted_weights(dataset):
@@ -651,21 +919,24 @@ def compute_adjusted_weights(dataset):
     :param dataset: dataset[0]: samples and names e.g. generic_filename; dataset[1] labels e.g. 0 or 1
     :return: set of weights/probabilities for each sample; represents how often it is picked
     """
-    weights = np.zeros(len(dataset[1]))
-    labels = list(set(dataset[1]))
-    occurrences = np.bincount(dataset[1])
-    probs = [100 * count/sum(occurrences) for count in occurrences]
+    return class_sample_weights(dataset[1], compute_adjusted_class_probs(dataset))
+
 
-    for idx, label in enumerate(labels):
-        weights[dataset[1] == label] = probs[idx] / occurrences[idx]
-    desired = 100 / len(labels) # desired probability per class
+def compute_adjusted_class_probs(dataset):
+    """
+    (!) The class mix of `compute_adjusted_weights` as one value per class, for a `ClassStratifiedSampler`
+    :param dataset: dataset[1] labels e.g. 0 or 1
+    :return: equal probability for every class present in the dataset
+    """
+    present = np.bincount(dataset[1]) > 0
+    return np.where(present, 100 / present.sum(), 0)
 
-    for idx, prob in enumerate(probs):
-        delta = desired - prob # unlikely to be 0
-        correction = delta / occurrences[idx]
-        weights[dataset[1] == labels[idx]] += correction
 
-    return weights
+def stratified_balance(trn, balance, stratified):
+    """ (!) The sampling of the training set for `prepare_from_path`: per-sample weights, or per-class probabilities
+        for a `ClassStratifiedSampler`. Returns weights, class_probs. """
+    if stratified: return None, compute_adjusted_class_probs(trn) if balance else np.bincount(trn[1])
+    return (compute_adjusted_weights(trn) if balance else None), None
 
 
 def balance_ds(dataset):
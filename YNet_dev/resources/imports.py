@@ -1,8 +1,6 @@
-from IPython.lib.deepreload import reload as dreload
-import PIL, os, numpy as np, math, collections, threading, json, bcolz, random, scipy, cv2
-import pandas as pd, pickle, sys, itertools, string, sys, re, datetime, time, shutil, copy
-import seaborn as sns, matplotlib
-import IPython, graphviz, sklearn_pandas, sklearn, warnings, pdb
+import PIL, os, numpy as np, math, collections, threading, json, random, cv2
+import pickle, sys, itertools, string, sys, re, datetime, time, shutil, copy
+import importlib, types, warnings, pdb
 import contextlib
 from abc import abstractmethod
 from glob import glob, iglob
@@ -10,22 +8,80 @@ from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from itertools import chain
 from functools import partial
 from collections import Iterable, Counter, OrderedDict
-from isoweek import Week
-from pandas_summary import DataFrameSummary
-from IPython.lib.display import FileLink
 from PIL import Image, ImageEnhance, ImageOps
-from sklearn import metrics, ensemble, preprocessing
 from operator import itemgetter, attrgetter
 from pathlib import Path
 from distutils.version import LooseVersion
 
-from matplotlib import pyplot as plt, rcParams, animation
-from ipywidgets import interact, interactive, fixed, widgets
-matplotlib.rc('animation', html='html5')
+
+class LazyModule(types.ModuleType):
+    """ (!) Stands in for a module that is only imported on first attribute access, e.g. `sns = LazyModule('seaborn')`,
+        so scripts that never use the notebook and plotting stack do not pay for importing it.
+        on_load is called with the module once it is imported. """
+
+    def __init__(self, name, on_load=None):
+        super().__init__(name)
+        self._lazy = (name, on_load)
+
+    def _load(self):
+        name, on_load = self.__dict__['_lazy']
+        module = importlib.import_module(name)
+        if on_load is not None: on_load(module)
+        self.__dict__.update(module.__dict__)  # later lookups are plain attribute hits
+        return module
+
+    def __getattr__(self, k): return getattr(self._load(), k)
+
+    def __dir__(self): return dir(self._load())
+
+
+class LazyAttr:
+    """ (!) Stands in for `from module import name`: imports the module on first use of the object
+        (calls, attributes and items). """
+
+    def __init__(self, module, name): self._lazy = (module, name)
+
+    def _obj(self):
+        module, name = self._lazy
+        return getattr(importlib.import_module(module), name)
+
+    def __call__(self, *args, **kwargs): return self._obj()(*args, **kwargs)
+
+    def __getattr__(self, k):
+        if k == '_lazy': raise AttributeError(k)
+        return getattr(self._obj(), k)
+
+    def __getitem__(self, k): return self._obj()[k]
+
+    def __setitem__(self, k, v): self._obj()[k] = v
+
+
+def _matplotlib_loaded(_):
+    import matplotlib
+    matplotlib.rc('animation', html='html5')
+
+# (!) heavy or notebook-only modules load on first use
+pd, scipy, bcolz = LazyModule('pandas'), LazyModule('scipy'), LazyModule('bcolz')
+sns = LazyModule('seaborn', _matplotlib_loaded)
+matplotlib = LazyModule('matplotlib', _matplotlib_loaded)
+plt = LazyModule('matplotlib.pyplot', _matplotlib_loaded)
+animation = LazyModule('matplotlib.animation', _matplotlib_loaded)
+rcParams = LazyAttr('matplotlib', 'rcParams')
+IPython, graphviz, sklearn_pandas = LazyModule('IPython'), LazyModule('graphviz'), LazyModule('sklearn_pandas')
+sklearn, metrics = LazyModule('sklearn'), LazyModule('sklearn.metrics')
+ensemble, preprocessing = LazyModule('sklearn.ensemble'), LazyModule('sklearn.preprocessing')
+widgets = LazyModule('ipywidgets.widgets')
+dreload = LazyAttr('IPython.lib.deepreload', 'reload')
+Week = LazyAttr('isoweek', 'Week')
+DataFrameSummary = LazyAttr('pandas_summary', 'DataFrameSummary')
+FileLink = LazyAttr('IPython.lib.display', 'FileLink')
+interact, interactive, fixed = [LazyAttr('ipywidgets', o) for o in ('interact', 'interactive', 'fixed')]
 np.set_printoptions(precision=5, linewidth=110, suppress=True)
 
-from ipykernel.kernelapp import IPKernelApp
-def in_notebook(): return IPKernelApp.initialized()
+def in_notebook():
+    if 'ipykernel' not in sys.modules: return False  # (!) a running kernel has imported it already
+    from ipykernel.kernelapp import IPKernelApp
+    return IPKernelApp.initialized()
 
 def in_ipynb():
     try:
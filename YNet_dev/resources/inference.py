@@ -0,0 +1,213 @@
+"""
+Batched scoring of image files with a trained model, without a notebook.
+
+    python -m resources.inference model.pt stats.dict plate_dir/ --sz 200 --out plate.csv
+
+The model file is either a TorchScript module (e.g. saved from `ResNet.export_inference(example)`) or a pickled
+module saved with `torch.save`; the stats are the pickled statistics from `common.data_source.Statistics`.
+Per-class stats are keyed by folder name, so pick one with --src-name, or pass the label dictionary of
+`prepare_from_path` as json (--lbl2index) together with --src-idx.
+"""
+from .imports import *
+from .torch_imports import *
+from .core import *
+from .transforms import *
+from .dataset import open_image
+import argparse, csv, queue
+
+
+class BatchScorer:
+    """
+    Scores image files with a model in micro-batches.
+
+    A thread pool decodes the images and puts them through the validation `Transforms`. A batch is run as soon as it
+    holds `bs` images or its oldest image has waited `max_latency` seconds, so a slow stream of paths is still scored
+    promptly. The model runs in eval mode under no_grad. Per-image latency (arrival to result) and throughput are
+    recorded for `report`. An image that cannot be read or transformed does not stop the run: `score` yields it with
+    None instead of probabilities and keeps the error in `failed`.
+
+    Arguments:
+        model: trained module returning log probabilities, e.g. `learn.model` or `ResNet.export_inference()`
+        tfms: validation `Transforms`, e.g. the second value of `tfms_from_stats`
+        src_idx: source to normalize with; required when tfms normalize per source (dict stats), where unlabeled
+            images have no other way to pick their stats
+        num_workers: decoding threads, defaults to the number of cpus
+        threads: torch intra-op threads for CPU inference, left unchanged if None
+    """
+
+    def __init__(self, model, tfms, bs=64, max_latency=0.05, src_idx=None, num_workers=None, threads=None):
+        self.model, self.tfms, self.bs, self.max_latency = model.eval(), tfms, bs, max_latency
+        self.src_idx, self.num_workers = src_idx, num_workers or num_cpus()
+        per_source = getattr(getattr(tfms, 'norm', None), 'd', None)
+        if per_source and src_idx is None:
+            raise ValueError(f'tfms normalize per source, pass the src_idx of the stats to use: one of {sorted(per_source)}')
+        if per_source and src_idx not in per_source:
+            raise ValueError(f'no stats for src_idx {src_idx}, the tfms have stats for {sorted(per_source)}')
+        if threads: torch.set_num_threads(threads)
+        params = list(model.parameters())
+        self.cuda = bool(params) and params[0].is_cuda
+        self.latencies, self.n, self.elapsed, self.failed = [], 0, 0., OrderedDict()  # path: error
+
+    def load(self, path):
+        """ The transformed image, or the exception raised while reading or transforming it """
+        # a dummy label with src_idx, in both modes: Normalize only picks per-source stats when given a label
+        try: x = self.tfms(open_image(path), 0, self.src_idx)
+        except Exception as e: return e
+        return x[0] if isinstance(x, tuple) else x
+
+    def predict(self, xs):
+        """ Class probabilities of a stacked batch of transformed images. """
+        if getattr(self.tfms, 'batch_mode', False):
+            n = len(xs)
+            src_idx = np.full(n, -1 if self.src_idx is None else self.src_idx)  # -1 only with single stats, see __init__
+            xs = self.tfms.batch_call(xs, np.zeros(n, dtype=np.int64), src_idx)[0]
+        x = torch.from_numpy(np.ascontiguousarray(xs, dtype=np.float32))
+        if self.cuda: x = x.cuda()
+        with no_grad_context():
+            out = self.model(x if IS_TORCH_04 else Variable(x, volatile=True))
+        return np.exp(to_np(out))
+
+    def score(self, paths):
+        """ Yields (path, class probabilities) for every path of the iterable `paths`, in order; the probabilities
+            are None for images that failed, see `failed`. """
+        pending, done = queue.Queue(self.bs * 4), object()
+        start = time.perf_counter()
+
+        with ThreadPoolExecutor(self.num_workers) as e:
+            def submit():
+                for path in paths: pending.put((path, time.perf_counter(), e.submit(self.load, path)))
+                pending.put(done)
+
+            submitter = threading.Thread(target=submit, daemon=True)
+            submitter.start()
+            batch, finished = [], False
+            while not finished:
+                timeout = None if not batch else max(0., batch[0][1] + self.max_latency - time.perf_counter())
+                try: item = pending.get(timeout=timeout)
+                except queue.Empty: item = None
+                if item is done: finished = True
+                elif item is not None: batch.append(item)
+                if batch and (finished or item is None or len(batch) == self.bs):
+                    xs = [fut.result() for _, _, fut in batch]
+                    ok = [i for i, x in enumerate(xs) if not isinstance(x, Exception)]
+                    probs = dict(zip(ok, self.predict(np.stack([xs[i] for i in ok])))) if ok else {}
+                    now = time.perf_counter()
+                    for i, (path, arrived, _) in enumerate(batch):
+                        if i in probs: self.latencies.append(now - arrived)
+                        else: self.failed[path] = f'{type(xs[i]).__name__}: {xs[i]}'
+                        yield path, probs.get(i)
+                    self.n += len(ok)
+                    batch = []
+            submitter.join()
+        self.elapsed += time.perf_counter() - start
+
+    def report(self):
+        """ Throughput in images/s, the 50th and 99th percentile latency in seconds and the number of failed images. """
+        if not self.n: return {'images': 0, 'failed': len(self.failed)} if self.failed else {}
+        p50, p99 = np.percentile(self.latencies, [50, 99])
+        return {'images': self.n, 'throughput': self.n / self.elapsed, 'p50': p50, 'p99': p99, 'failed': len(self.failed)}
+
+
+def image_paths(source):
+    """ TIFF files below a directory (sorted), a single file, or, for '-', paths read from stdin as they arrive. """
+    if source == '-': return (line.strip() for line in sys.stdin if line.strip())
+    if os.path.isdir(source):
+        return sorted(p for ext in ('tif', 'tiff') for p in glob(os.path.join(source, '**', f'*.{ext}'), recursive=True))
+    return [source]
+
+
+def write_probs(results, f, classes=None, failed=None):
+    """ Writes (path, probabilities) pairs as csv rows, with an error column for images that failed (probabilities
+        None, error message looked up in `failed`, e.g. the live `BatchScorer.failed`); returns the number of rows. """
+    writer, n, pending = csv.writer(f), 0, []
+    errors = failed if failed is not None else {}
+    n_cols = None if classes is None else len(classes)
+
+    def header(n):
+        writer.writerow(['path'] + list(classes if classes is not None else range(n)) + ['error'])
+
+    if n_cols is not None: header(n_cols)
+    for path, p in results:
+        n += 1
+        if p is None: pending.append(path)  # failed rows wait until the number of columns is known
+        elif n_cols is None:
+            n_cols = len(p)
+            header(n_cols)
+        if n_cols is None: continue
+        for failed_path in pending: writer.writerow([failed_path] + [''] * n_cols + [errors.get(failed_path, 'failed')])
+        pending = []
+        if p is not None: writer.writerow([path] + [f'{o:.6f}' for o in p] + [''])
+    if pending:  # no image succeeded
+        header(0)
+        for path in pending: writer.writerow([path, errors.get(path, 'failed')])
+    return n
+
+
+def remap_stats(stats, lbl2index):
+    """ Rekeys per-source stats saved by `Statistics.per_class` (keyed by folder name) by source index, like the
+        notebooks do before `tfms_from_stats`. lbl2index: the label dictionary of `prepare_from_path`. """
+    missing = [k for k in stats if k not in lbl2index]
+    if missing: raise ValueError(f'no source index for the stats of {missing} in lbl2index')
+    return {(lbl2index[k][0] if isinstance(lbl2index[k], (list, tuple)) else lbl2index[k]): v for k, v in stats.items()}
+
+
+def load_stats(fn, src_name=None, lbl2index=None):
+    """
+    Statistics pickled by `Statistics`, ready for `tfms_from_stats`. Per-class stats are keyed by folder name in the
+    pickle: src_name picks the stats of one folder, lbl2index (as saved by `main`'s --lbl2index json) rekeys them by
+    source index, to be picked with src_idx.
+    """
+    with open(fn, 'rb') as f: stats = pickle.load(f)
+    if not isinstance(stats, dict): return stats
+    if src_name is not None:
+        if src_name not in stats: raise ValueError(f'no stats for {src_name}, the file has stats for {sorted(stats)}')
+        return stats[src_name]
+    if lbl2index is not None: return remap_stats(stats, lbl2index)
+    if all(isinstance(k, (int, np.integer)) for k in stats): return stats
+    raise ValueError(f'the stats are keyed by folder name {sorted(stats)}: pass src_name, or lbl2index and a src_idx')
+
+
+def load_model(fn):
+    try: return torch.jit.load(fn, map_location='cpu')
+    except Exception: return torch.load(fn, map_location='cpu')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score TIFF images with a trained model.')
+    parser.add_argument('model', help='TorchScript module or module saved with torch.save')
+    parser.add_argument('stats', help='pickled statistics, as saved by Statistics')
+    parser.add_argument('source', help="directory of TIFF images, a single image, or '-' to read paths from stdin")
+    parser.add_argument('--sz', type=int, required=True, help='image size the model was trained with')
+    parser.add_argument('--out', default='-', help="csv file for the probabilities, '-' for stdout")
+    parser.add_argument('--classes', nargs='*', help='class names, in the order of the model outputs')
+    parser.add_argument('--src-name', help='folder whose statistics to normalize with, for per-source statistics')
+    parser.add_argument('--lbl2index', help='json of the label dictionary of prepare_from_path, to use --src-idx with '
+                                            'per-source statistics')
+    parser.add_argument('--src-idx', type=int, help='source index to normalize with, see --lbl2index')
+    parser.add_argument('--bs', type=int, default=64)
+    parser.add_argument('--max-latency', type=float, default=0.05, help='seconds a partial batch may wait')
+    parser.add_argument('--workers', type=int, help='decoding threads')
+    parser.add_argument('--threads', type=int, help='torch threads')
+    args = parser.parse_args()
+
+    lbl2index = None
+    if args.lbl2index:
+        with open(args.lbl2index) as f: lbl2index = json.load(f)
+    try:
+        stats = load_stats(args.stats, args.src_name, lbl2index)
+        _, val_tfms = tfms_from_stats(stats, args.sz)
+        scorer = BatchScorer(load_model(args.model), val_tfms, args.bs, args.max_latency, args.src_idx, args.workers,
+                             args.threads)
+    except ValueError as e: parser.error(str(e))
+    f = open(args.out, 'w', newline='') if args.out != '-' else sys.stdout
+    try: write_probs(scorer.score(image_paths(args.source)), f, args.classes, scorer.failed)
+    finally:
+        if f is not sys.stdout: f.close()
+    r = scorer.report()
+    if r.get('images'): print(f"{r['images']} images, {r['throughput']:.1f} images/s, "
+                              f"latency p50 {r['p50'] * 1e3:.1f} ms, p99 {r['p99'] * 1e3:.1f} ms", file=sys.stderr)
+    if r.get('failed'): print(f"{r['failed']} images failed, see the error column", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
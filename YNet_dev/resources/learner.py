@@ -11,6 +11,7 @@ from .metrics import *
 from .losses import *
 from .swa import *
 from .fp16 import *
+from .inference import BatchScorer
 from .lsuv_initializer import apply_lsuv_init
 import time
 
@@ -408,9 +409,26 @@ class Learner():
 
     def predict_array(self, arr):
         self.model.eval()
-        return to_np(self.model(to_gpu(V(T(arr)))))
+        with no_grad_context(): return to_np(self.model(to_gpu(V(T(arr)))))
 
-    def TTA(self, n_aug=4, is_test=False):
+    def predict_paths(self, paths, bs=64, src_idx=None, num_workers=None):
+        """ (!) Class probabilities of image files, decoded and transformed like the validation set, see `BatchScorer`
+
+        Arguments:
+            src_idx: source whose stats normalize the images; required when the data is normalized per source
+
+        Returns:
+            paths (list), probabilities (numpy.ndarray, NaN rows for images that could not be read),
+            report (dict): throughput, latency percentiles and the number of failed images
+        """
+        scorer = BatchScorer(self.model, self.data.val_ds.transform, bs, src_idx=src_idx, num_workers=num_workers)
+        results = list(scorer.score(paths))
+        probs = np.full((len(results), self.data.c), np.nan, dtype=np.float32)
+        for i, (_, p) in enumerate(results):
+            if p is not None: probs[i] = p
+        return [path for path, _ in results], probs, scorer.report()
+
+    def TTA(self, n_aug=4, is_test=False, dihedral=False):
         """ Predict with Test Time Augmentation (TTA)
 
         Additional to the original test/validation images, apply image augmentation to them
@@ -421,6 +439,9 @@ class Learner():
         Args:
             n_aug: a number of augmentation images to use per original image
             is_test: indicate to use test images; otherwise use validation images
+            dihedral: (!) instead of n_aug random augmentations, predict the 8 dihedral views (rotations and flips) of
+                each image. Images are read once and all views go through the model in one batch, so this takes a
+                single pass; n_aug is ignored.
 
         Returns:
             (tuple): a tuple containing:
@@ -429,6 +450,7 @@ class Learner():
                 targs (numpy.ndarray): target values when `is_test==False`; zeros otherwise.
         """
         dl1 = self.data.test_dl if is_test else self.data.val_dl
+        if dihedral: return predict_dihedral_with_targs(self.model, dl1)
         dl2 = self.data.test_aug_dl if is_test else self.data.aug_dl
         preds1, targs = predict_with_targs(self.model, dl1)
         preds1 = [preds1] * math.ceil(n_aug / 4)
@@ -2,10 +2,11 @@ from .imports import *
 from .torch_imports import *
 from .core import *
 from .layer_optimizer import *
-from sklearn.metrics import confusion_matrix, f1_score
+confusion_matrix, f1_score = LazyAttr('sklearn.metrics', 'confusion_matrix'), LazyAttr('sklearn.metrics', 'f1_score')  # (!)
 from .swa import *
 from .fp16 import *
 from typing import Generator
+import queue
 
 IS_TORCH_04 = LooseVersion(torch.__version__) >= LooseVersion('0.4')
 GLOBAL_STEP = 0
@@ -14,15 +15,44 @@ def cut_model(m, cut):
     return list(m.children())[:cut] if cut else [m]
 
 
-def predict_to_bcolz(m, gen, arr, workers=4):
-    arr.trim(len(arr))
-    lock = threading.Lock()
+def predict_to_memmap(m, gen, arr, chunk_rows=4096):
+    """ Writes the outputs of m for the batches of gen into the preallocated array arr (e.g. a `.npy` memory map),
+        from row 0 on; returns the number of rows written.
+        (!) A background thread writes them in chunks of at least chunk_rows rows and flushes once at the end,
+        while the model already runs on the next batches.
+    """
     m.eval()
-    for x, *_ in tqdm(gen):
-        y = to_np(m(VV(x)).data)
-        with lock:
-            arr.append(y)
-            arr.flush()
+    q, errors, pos = queue.Queue(8), [], [0]
+
+    def write():
+        buf, n = [], 0
+        try:
+            for y in iter(q.get, None):
+                buf.append(y)
+                n += len(y)
+                if n >= chunk_rows:
+                    arr[pos[0]:pos[0] + n] = np.concatenate(buf)
+                    pos[0] += n
+                    buf, n = [], 0
+            if buf: arr[pos[0]:pos[0] + n] = np.concatenate(buf)
+            pos[0] += n
+            if hasattr(arr, 'flush'): arr.flush()
+        except Exception as e:
+            errors.append(e)
+            for _ in iter(q.get, None): pass  # keep draining so the producer never blocks
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    try:
+        with no_grad_context():
+            for x, *_ in tqdm(gen):
+                if errors: break
+                q.put(to_np(m(VV(x)).data))
+    finally:
+        q.put(None)
+        writer.join()
+    if errors: raise errors[0]
+    return pos[0]
 
 
 def num_features(m):
@@ -39,9 +69,10 @@ def torch_item(x): return x.item() if hasattr(x, 'item') else x[0]
 
 class Stepper:  # (!) this is sort of an optimized wrappers
 
-    def __init__(self, m, opt, crit, clip=0, reg_fn=None, fp16=False, loss_scale=1):
+    def __init__(self, m, opt, crit, clip=0, reg_fn=None, fp16=False, loss_scale=1, defer_loss=False):
+        """ defer_loss: (!) `step` returns the loss as a detached device tensor instead of reading it back """
         self.m, self.opt, self.crit, self.clip, self.reg_fn = m, opt, crit, clip, reg_fn
-        self.fp16 = fp16
+        self.fp16, self.defer_loss = fp16, defer_loss
         self.reset(True)
         if self.fp16: self.fp32_params = copy_model_to_fp32(m, opt)
         self.loss_scale = loss_scale
@@ -85,7 +116,7 @@ class Stepper:  # (!) this is sort of an optimized wrappers
         if self.fp16:
             copy_fp32_to_model(self.m, self.fp32_params)
             torch.cuda.synchronize()
-        return torch_item(raw_loss.data)
+        return raw_loss.data if self.defer_loss else torch_item(raw_loss.data)
 
     def evaluate(self, xs, y):
         preds = self.m(*xs)
@@ -116,13 +147,18 @@ def fit(model, data, n_epochs, opt, crit, metrics=None, callbacks=None, stepper=
        If n_epochs is a list, it needs to be the layer_optimizer to get the optimizer as it changes.
        n_epochs(int or list): number of epochs (or list of number of epochs)
        crit: loss function to optimize. Example: F.cross_entropy
+       loss_every (int): (!) read the training loss back from the device every loss_every steps only; the running loss
+           stays a device tensor in between. Forced to 1 when a callback has `needs_batch_loss` set.
     """
     metrics_data = data
 
     all_val = kwargs.pop('all_val') if 'all_val' in kwargs else False
     get_ep_vals = kwargs.pop('get_ep_vals') if 'get_ep_vals' in kwargs else False
+    loss_every = kwargs.pop('loss_every', 1)
     metrics = metrics or []
     callbacks = callbacks or []
+    if any(getattr(cb, 'needs_batch_loss', False) for cb in callbacks): loss_every = 1
+    if loss_every > 1: kwargs['defer_loss'] = True
     avg_mom = 0.98
     batch_num, avg_loss = 0, 0.
     for cb in callbacks:
@@ -164,8 +200,11 @@ def fit(model, data, n_epochs, opt, crit, metrics=None, callbacks=None, stepper=
         #  potentially overwriting original settings in dataloader...
         
         if adjust_class is not None:
-            flx_weights = adjust_weights(cur_data.trn_dl, adjust_class)
-            cur_data.trn_dl.set_dynamic_sampler(flx_weights)
+            trn_dl = cur_data.trn_dl
+            if trn_dl.stratified:  # (!) O(num_classes), see ClassStratifiedSampler
+                trn_dl.set_class_probs(adjust_class_probs(trn_dl.class_counts(), adjust_class))
+            else:
+                trn_dl.set_dynamic_sampler(adjust_weights(trn_dl, adjust_class))
         if adjust_class is None:
             cur_data.trn_dl.reset_sampler() 
         # (!) END
@@ -177,8 +216,12 @@ def fit(model, data, n_epochs, opt, crit, metrics=None, callbacks=None, stepper=
             for cb in callbacks: cb.on_batch_begin()
             loss = model_stepper.step(V(x), V(y), epoch)
             avg_loss = avg_loss * avg_mom + loss * (1 - avg_mom)
-            debias_loss = avg_loss / (1 - avg_mom ** batch_num)
-            t.set_postfix(loss=debias_loss)
+            if loss_every == 1:
+                debias_loss = avg_loss / (1 - avg_mom ** batch_num)
+                t.set_postfix(loss=debias_loss)
+            elif (batch_num - 1) % loss_every == 0:  # (!) deferred readback, callbacks see the latest value
+                debias_loss = torch_item(avg_loss) / (1 - avg_mom ** batch_num)
+                t.set_postfix(loss=debias_loss)
             stop = False
             los = debias_loss if not all_val else [debias_loss] + validate_next(model_stepper, metrics, val_iter)
             for cb in callbacks:
@@ -198,15 +241,18 @@ def fit(model, data, n_epochs, opt, crit, metrics=None, callbacks=None, stepper=
                 if cur_data != data[phase]:
                     t.close()
                     break
+        if loss_every > 1: debias_loss = torch_item(avg_loss) / (1 - avg_mom ** batch_num)
         # (!) START logging
         global GLOBAL_STEP
         print(f"EPOCH {epoch} {'-' * 40} STEP {GLOBAL_STEP}")
         print_dist.describe()
-        per_class_accuracies(metrics_data, model, GLOBAL_STEP)
+        if all_val: per_class_accuracies(metrics_data, model, GLOBAL_STEP)
         # (!) END
 
         if not all_val:
-            vals = validate(model_stepper, cur_data.val_dl, metrics)
+            # (!) one pass over the validation set for the loss, metrics, per-class accuracies and f1 scores
+            vals, val_preds, val_targs = validate_with_preds(model_stepper, cur_data.val_dl, metrics)
+            per_class_accuracies(metrics_data, model, GLOBAL_STEP, val_preds, val_targs)
             stop = False
             for cb in callbacks: stop = stop or cb.on_epoch_end(vals)
             if swa_model is not None:
@@ -223,7 +269,8 @@ def fit(model, data, n_epochs, opt, crit, metrics=None, callbacks=None, stepper=
             if hasattr(model,'writer'):  # (!) added a tensorboard logger
                 tensorboard_log(model, GLOBAL_STEP, [debias_loss] + vals)
                 # (!) added f1 score logging to tensorboard
-                log_f1_score(metrics_data.val_dl, model, GLOBAL_STEP)
+                log_f1_score(metrics_data.val_dl, model, GLOBAL_STEP, val_preds, val_targs)
+                if hasattr(model, 'log_activations'): model.log_activations()
 
             ep_vals = append_stats(ep_vals, epoch, [debias_loss] + vals)
 
@@ -281,7 +328,13 @@ def validate_next(stepper, metrics, val_iter):
 
 
 def validate(stepper, dl, metrics):
-    batch_cnts, loss, res = [], [], []
+    return validate_with_preds(stepper, dl, metrics, keep_preds=False)[0]
+
+
+def validate_with_preds(stepper, dl, metrics, keep_preds=True): # (!)
+    """ Like `validate`, but also returns the predictions and targets of the same pass as numpy arrays,
+        so per-class accuracies and f1 scores need no further passes over dl. """
+    batch_cnts, loss, res, all_preds, targs = [], [], [], [], []
     stepper.reset(False)
     with no_grad_context():
         for (*x, y) in iter(dl):
@@ -292,7 +345,12 @@ def validate(stepper, dl, metrics):
                 batch_cnts.append(len(x))
             loss.append(to_np(l))
             res.append([f(preds.data, y) for f in metrics])
-    return [np.average(loss, 0, weights=batch_cnts)] + list(np.average(np.stack(res), 0, weights=batch_cnts))
+            if keep_preds:
+                all_preds.append(to_np(preds))
+                targs.append(to_np(y))
+    vals = [np.average(loss, 0, weights=batch_cnts)] + list(np.average(np.stack(res), 0, weights=batch_cnts))
+    if not keep_preds: return vals, None, None
+    return vals, np.concatenate(all_preds), np.concatenate(targs)
 
 
 def get_prediction(x):
@@ -324,6 +382,36 @@ def predict_with_targs(m, dl):
     return np.concatenate(preda), np.concatenate(targa)
 
 
+def dihedral_views(x): # (!)
+    """ The 8 dihedral views of a square (N,C,H,W) tensor batch, concatenated along the batch dimension in the order of
+        `transforms.dihedral(x, dih)` for dih in 0..7: rotations by 0-3 quarter turns, then the same flipped left-right. """
+    rev = torch.arange(x.size(3) - 1, -1, -1).long()
+    if x.is_cuda: rev = rev.cuda()
+    views = [x]
+    for _ in range(3): views.append(views[-1].transpose(2, 3).index_select(2, rev))  # np.rot90 on (H,W)
+    views += [v.index_select(3, rev) for v in views]
+    return torch.cat([v.contiguous() for v in views])
+
+
+def predict_dihedral_with_targs(m, dl): # (!)
+    """ Predictions for the 8 dihedral views of every image of dl, from one pass over dl and one forward per batch.
+
+    Returns:
+        preds (numpy.ndarray): of shape (8, len(dl.dataset), n_out), views ordered like `dihedral_views`
+        targs (numpy.ndarray)
+    """
+    m.eval()
+    if hasattr(m, 'reset'): m.reset()
+    res = []
+    with no_grad_context():
+        for x, *_, y in tqdm(iter(dl), leave=False):
+            preds = m(VV(dihedral_views(x)))
+            if is_listy(preds): preds = preds[0]
+            res.append([to_np(preds).reshape(8, len(x), -1), to_np(y)])
+    preda, targa = zip(*res)
+    return np.concatenate(preda, axis=1), np.concatenate(targa)
+
+
 # From https://github.com/ncullen93/torchsample
 def model_summary(m, input_size):
     def register_hook(module):
@@ -370,26 +458,26 @@ def model_summary(m, input_size):
     return summary
 
 
-def per_class_accuracies(data, model, epoch:int):  # (!) may not work for non classification problems
+def class_confusion(targets, choices, n=None): # (!)
+    """ Confusion matrix with true classes as rows and predicted classes as columns. """
+    targets, choices = np.asarray(targets, dtype=np.int64), np.asarray(choices, dtype=np.int64)
+    n = n or int(max(targets.max(), choices.max())) + 1
+    return np.bincount(targets * n + choices, minlength=n * n).reshape(n, n)
 
-    class_correct, class_total = {}, {}
-    data_loader = data.val_dl
-    log_predictions, targets = predict_with_targs(model, data_loader)
-    predictions = np.exp(log_predictions)
-    choices = np.argmax(predictions, axis=1)
-    for choice, truth in zip(choices, targets):
-        if truth not in class_total:
-            class_correct[truth] = 0
-            class_total[truth] = 0
-        class_correct[truth] += int(choice == truth)
-        class_total[truth] += 1
 
-    accuracy = {data.classes[label]: 100. * correct / class_total[label] for label, correct in class_correct.items()}
+def per_class_accuracies(data, model, epoch:int, preds=None, targets=None):  # (!) may not work for non classification problems
+    """ Logs the accuracy per class of the validation set; pass preds and targets (e.g. from `validate_with_preds`)
+        to skip predicting it again. Returns the confusion matrix. """
+    if preds is None: preds, targets = predict_with_targs(model, data.val_dl)
+    cm = class_confusion(targets, np.argmax(preds, axis=1), len(data.classes))
+    class_total = cm.sum(1)
+    accuracy = {data.classes[label]: 100. * cm[label, label] / class_total[label] for label in np.flatnonzero(class_total)}
 
     if hasattr(model,'writer'):
         model.writer.add_scalars("class_accuracies", accuracy, epoch)
     for label, accuracy in accuracy.items():
         print(f"[{label}]: {accuracy:4.4}%")
+    return cm
 
 def compute_predictions(model, data_loader) -> Generator: # (!) util
     data_iter = iter(data_loader)
@@ -434,90 +522,83 @@ def adjust_weights(data_loader, class_: dict):
     :param class_: dict that represents class ratios in the coming batches {0:50, 1:45}
     :return: float array
     """
-    ys = [pair[1] for pair in data_loader.dataset]  # all ys
-    weights = np.zeros(len(ys))
-    labels = np.unique(ys)
-    occurrences = np.bincount(ys)
+    ys = data_loader.dataset.labels()  # (!) all ys, without loading any image
+    return class_sample_weights(ys, adjust_class_probs(np.bincount(ys), class_))
+
+
+def adjust_class_probs(occurrences, class_: dict):
+    """
+    (!) The class mix of `adjust_weights` as one value per class, e.g. for `DataLoader.set_class_probs`
+    :param occurrences: number of samples per class
+    :param class_: dict that represents class ratios in the coming batches {0:50, 1:45}
+    :return: float array of length len(occurrences)
+    """
+    occurrences = np.asarray(occurrences)
     print(occurrences)
 
     # compute desired weights
     assert class_ != {}
     total = sum(value for _, value in class_.items())
     assert total <= 100
-    other_classes = (100 - total) / (len(labels) - len(class_))
-    desired = [class_[label] if label in class_ else other_classes for label in labels]
-
-    for idx, desired_weight in zip(range(len(labels)), desired):
-        correction = desired_weight / occurrences[idx]
-        weights[ys == labels[idx]] += correction
-
-    return weights
+    n_labels = np.count_nonzero(occurrences)
+    other_classes = (100 - total) / (n_labels - len(class_)) if n_labels > len(class_) else 0
+    desired = np.where(occurrences > 0, other_classes, 0.)
+    for label, value in class_.items(): desired[label] = value
+    return desired
 
 
 def compute_weights_distribution(cm, data_loader): # (!)
     # determine which classes are often confused with each other
     if not isinstance(cm, np.ndarray): cm = np.array(cm)
     n = cm.shape[0]
-    confused_with = [0 for _ in range(n)]
-    for i in range(n):
-        row = [(val, idx) for idx, val in enumerate(cm[i])]
-        row.sort(key=lambda x: x[0],reverse=True)
-        if row[0][1] == i:
-            confused_with[i] = row[1]
-        else:
-            confused_with[i] = row[0]
+    off_diagonal = cm.astype(np.float64)
+    np.fill_diagonal(off_diagonal, -np.inf)
+    confused_with = list(zip(off_diagonal.max(1), off_diagonal.argmax(1)))  # (count, class) per true class
 
     print(confused_with)
 
-    o = np.argmax(confused_with, axis=0)[0]
-    c = confused_with[o][1]  # class that o get confused with most often
+    o = int(np.argmax(off_diagonal.max(1)))
+    c = int(off_diagonal.argmax(1)[o])  # class that o get confused with most often
     print(f"original class: [{o}]; getting confused with: [{c}]")
-    # compute normal batch_weights
-    ys = [pair[1] for pair in data_loader.dataset] # all ys
-    weights = np.zeros(len(ys))
-    labels = np.unique(ys)
-    occurrences = np.bincount(ys)
-    probs = [100 * count/sum(occurrences) for count in occurrences]
-
-    for idx, label in enumerate(labels):
-        weights[ys == label] = probs[idx] / occurrences[idx]
 
     # compute desired batch_weights
+    ys = data_loader.dataset.labels() # (!) all ys, without loading any image
+    n_labels = np.count_nonzero(np.bincount(ys, minlength=n))
     ratio = 35
-    other_classes = (100 - 2*ratio) / (len(labels) - 2)
-    dist = [35 if idx in [o, c] else other_classes for idx in range(n)]
-
-    for idx, desired_weight, current_weight in zip(range(n), dist, probs):
-        delta = desired_weight - current_weight
-        correction = delta / occurrences[idx]
-        weights[ys == labels[idx]] += correction
+    other_classes = (100 - 2*ratio) / (n_labels - 2)
+    dist = [ratio if idx in [o, c] else other_classes for idx in range(n)]
 
-    return weights
+    return class_sample_weights(ys, dist)
 
 
 class PrintDistribution:
+    """ (!) Mean and stdev over batches of the (floored) percentage of each class in a batch.
+
+        Sums of the percentages and of their squares are accumulated on the device of the labels, so no batch
+        waits for a device sync and memory stays constant; they are only read back in `describe`.
+    """
     def __init__(self,num_classes):
-        self.ps = []
         self.num_classes = num_classes
+        self.n, self.sum_p, self.sum_p2 = 0, None, None
 
     def __call__(self, y):
-        y = y.cpu().numpy().copy()  # gonna eat up a lot of memory
-        occurences = np.bincount(y, minlength=self.num_classes)
-
-        percentages = np.array([int(100 * count / sum(occurences)) for count in occurences])
-        self.ps.append(percentages)
+        if self.sum_p is None: self.sum_p, self.sum_p2 = [y.new(self.num_classes).zero_() for _ in range(2)]
+        occurences = y.new(self.num_classes).zero_().index_add_(0, y, y.new(len(y)).fill_(1))
+        percentages = (occurences * 100).div_(len(y))  # integer div floors: int(100 * count / sum(occurences))
+        self.sum_p += percentages
+        self.sum_p2 += percentages * percentages
+        self.n += 1
 
     def describe(self):
-        self.ps = np.stack(self.ps)
-        mean = np.mean(self.ps, axis=0)
-        stdev = np.std(self.ps, axis=0)
+        if not self.n: return
+        mean = to_np(self.sum_p).astype(np.float64) / self.n
+        stdev = np.sqrt(np.maximum(to_np(self.sum_p2) / self.n - mean ** 2, 0))
         print(f"mean: {mean}\nstdev: {stdev}\n")
 
 
-def log_f1_score(data_loader, model, epoch):
-    log_predictions, targets = predict_with_targs(model, data_loader)
-    predictions = np.exp(log_predictions)
-    choices = np.argmax(predictions, axis=1)
+def log_f1_score(data_loader, model, epoch, preds=None, targets=None):
+    if preds is None: preds, targets = predict_with_targs(model, data_loader)
+    choices = np.argmax(preds, axis=1)
     wscore = f1_score(targets, choices, average='weighted')
     model.writer.add_scalar("f1_weighted_score", wscore, epoch)
     print(f"f1 weighted average score: [{wscore:4.4}]")
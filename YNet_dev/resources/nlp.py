@@ -6,6 +6,7 @@ from .dataset import *
 from .learner import *
 from .text import *
 from .lm_rnn import *
+import torchtext
 
 from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.model_selection import train_test_split
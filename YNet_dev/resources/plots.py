@@ -1,6 +1,6 @@
 from .imports import *
 from .torch_imports import *
-from sklearn.metrics import confusion_matrix
+confusion_matrix = LazyAttr('sklearn.metrics', 'confusion_matrix')  # (!) sklearn loads on first use
 
 def ceildiv(a, b):
     return -(-a // b)
@@ -39,12 +39,14 @@ def plots_from_files(imspaths, figsize=(10,5), rows=1, titles=None, maintitle=No
         plt.imshow(img)
 
 
-def plot_confusion_matrix(cm, classes, normalize=False, title='Confusion matrix', cmap=plt.cm.Blues, figsize=None):
+def plot_confusion_matrix(cm, classes, normalize=False, title='Confusion matrix', cmap=None, figsize=None):
     """
     This function prints and plots the confusion matrix.
     Normalization can be applied by setting `normalize=True`.
     (This function is copied from the scikit docs.)
+    (!) cmap defaults to plt.cm.Blues, looked up here so importing this module does not load matplotlib
     """
+    if cmap is None: cmap = plt.cm.Blues
     plt.figure(figsize=figsize)
     plt.imshow(cm, interpolation='nearest', cmap=cmap)
     plt.title(title)
@@ -8,7 +8,12 @@ class Callback:
     '''
     An abstract class that all callback(e.g., LossRecorder) classes extends from. 
     Must be extended before usage.
+
+    (!) needs_batch_loss: set by callbacks that need the loss of every batch, so that `fit(loss_every=K)` still reads
+    the loss back from the device after each step. Other callbacks get the latest read-back loss.
     '''
+    needs_batch_loss = False
+
     def on_train_begin(self): pass
     def on_batch_begin(self): pass
     def on_phase_begin(self): pass
@@ -161,6 +166,8 @@ class LR_Finder(LR_Updater):
     Helps you find an optimal learning rate for a model, as per suggetion of 2015 CLR paper. 
     Learning rate is increased in linear or log scale, depending on user input, and the result of the loss funciton is retained and can be plotted later. 
     '''
+    needs_batch_loss = True
+
     def __init__(self, layer_opt, nb, end_lr=10, linear=False, metrics = []):
         self.linear, self.stop_dv = linear, True
         ratio = end_lr/layer_opt.lr
@@ -532,6 +539,9 @@ class OptimScheduler(LossRecorder):
         self.phases, self.nb_batches, self.stop_div = phases, nb_batches, stop_div
         super().__init__(layer_opt, record_mom=True)
 
+    @property
+    def needs_batch_loss(self): return self.stop_div
+
     def on_train_begin(self):
         super().on_train_begin()
         self.phase,self.best=0,1e9
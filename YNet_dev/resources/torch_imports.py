@@ -1,5 +1,5 @@
 import os
-import torch, torchvision, torchtext
+import torch, torchvision
 from torch import nn, cuda, backends, FloatTensor, LongTensor, optim
 import torch.nn.functional as F
 from torch.autograd import Variable
@@ -10,14 +10,12 @@ from torchvision.models import resnet18, resnet34, resnet50, resnet101, resnet15
 from torchvision.models import vgg16_bn, vgg19_bn
 from torchvision.models import densenet121, densenet161, densenet169, densenet201
 
-from .models.resnext_50_32x4d import resnext_50_32x4d
-from .models.resnext_101_32x4d import resnext_101_32x4d
-from .models.resnext_101_64x4d import resnext_101_64x4d
-from .models.wrn_50_2f import wrn_50_2f
-from .models.inceptionresnetv2 import InceptionResnetV2
-from .models.inceptionv4 import inceptionv4
-from .models.nasnet import nasnetalarge
 from .models.fa_resnet import *
+# (!) the other model definitions are imported by the functions below when first called
+
+def nasnetalarge(*args, **kwargs):
+    from .models.nasnet import nasnetalarge
+    return nasnetalarge(*args, **kwargs)
 
 import warnings
 warnings.filterwarnings('ignore', message='Implicit dimension choice', category=UserWarning)
@@ -45,27 +43,39 @@ def _fastai_model(name, paper_title, paper_href):
 
 @_fastai_model('Inception 4', 'Inception-v4, Inception-ResNet50 and the Impact of Residual Connections on Learning',
                'https://arxiv.org/pdf/1602.07261.pdf')
-def inception_4(pre): return children(inceptionv4(pretrained=pre))[0]
+def inception_4(pre):
+    from .models.inceptionv4 import inceptionv4
+    return children(inceptionv4(pretrained=pre))[0]
 
 @_fastai_model('Inception 4', 'Inception-v4, Inception-ResNet50 and the Impact of Residual Connections on Learning',
                'https://arxiv.org/pdf/1602.07261.pdf')
-def inceptionresnet_2(pre): return load_pre(pre, InceptionResnetV2, 'inceptionresnetv2-d579a627')
+def inceptionresnet_2(pre):
+    from .models.inceptionresnetv2 import InceptionResnetV2
+    return load_pre(pre, InceptionResnetV2, 'inceptionresnetv2-d579a627')
 
 @_fastai_model('ResNeXt 50', 'Aggregated Residual Transformations for Deep Neural Networks',
                'https://arxiv.org/abs/1611.05431')
-def resnext50(pre): return load_pre(pre, resnext_50_32x4d, 'resnext_50_32x4d')
+def resnext50(pre):
+    from .models.resnext_50_32x4d import resnext_50_32x4d
+    return load_pre(pre, resnext_50_32x4d, 'resnext_50_32x4d')
 
 @_fastai_model('ResNeXt 101_32', 'Aggregated Residual Transformations for Deep Neural Networks',
                'https://arxiv.org/abs/1611.05431')
-def resnext101(pre): return load_pre(pre, resnext_101_32x4d, 'resnext_101_32x4d')
+def resnext101(pre):
+    from .models.resnext_101_32x4d import resnext_101_32x4d
+    return load_pre(pre, resnext_101_32x4d, 'resnext_101_32x4d')
 
 @_fastai_model('ResNeXt 101_64', 'Aggregated Residual Transformations for Deep Neural Networks',
                'https://arxiv.org/abs/1611.05431')
-def resnext101_64(pre): return load_pre(pre, resnext_101_64x4d, 'resnext_101_64x4d')
+def resnext101_64(pre):
+    from .models.resnext_101_64x4d import resnext_101_64x4d
+    return load_pre(pre, resnext_101_64x4d, 'resnext_101_64x4d')
 
 @_fastai_model('Wide Residual Networks', 'Wide Residual Networks',
                'https://arxiv.org/pdf/1605.07146.pdf')
-def wrn(pre): return load_pre(pre, wrn_50_2f, 'wrn_50_2f')
+def wrn(pre):
+    from .models.wrn_50_2f import wrn_50_2f
+    return load_pre(pre, wrn_50_2f, 'wrn_50_2f')
 
 @_fastai_model('Densenet-121', 'Densely Connected Convolutional Networks',
                'https://arxiv.org/pdf/1608.06993.pdf')
@@ -220,6 +220,19 @@ class Normalize:
 
         self.tfm_y=tfm_y
 
+    batchable = True
+    uses_src_idx = True  # (!) compose passes src_idx
+
+    def batch_call(self, x, y, src_idx):
+        """ Normalizes a collated (N,H,W,C) batch; src_idx entries of -1 fall back to the class label y. """
+        if self.d:
+            keys = np.where(src_idx >= 0, src_idx, y)
+            u_keys, inv = np.unique(keys, return_inverse=True)
+            m = np.stack([self.d[k][0] for k in u_keys]).astype(np.float32)[inv]
+            s = np.stack([self.d[k][1] for k in u_keys]).astype(np.float32)[inv]
+            return (x - m[:, None, None, :]) / s[:, None, None, :]
+        return (x - self.m) / self.s
+
     def __call__(self, x, y=None, src_idx=None):
         if self.d and y is not None:
             if src_idx is not None:
@@ -243,9 +256,13 @@ class ChannelOrder():
     tfm_y decides the transformation done to the y element. 
     '''
 
+    batchable = True
+
     def __init__(self, tfm_y=TfmType.NO):
         self.tfm_y = tfm_y
 
+    def batch_call(self, x, y, src_idx): return x.transpose(0, 3, 1, 2)
+
     def __call__(self, x, y):
         x = np.rollaxis(x, 2)
         # if isinstance(y,np.ndarray) and (len(y.shape)==3):
@@ -256,6 +273,54 @@ class ChannelOrder():
         return x, y
 
 
+class FusedNormalize:
+    """ (!) `Normalize` followed by `ChannelOrder` in a single pass.
+
+        Writes (x-m)/s of an (H,W,C) image straight into a new (C,H,W) array of `dtype`, instead of a normalized
+        float64 copy that `ChannelOrder` and `T` then copy again. `batch_call` does the same for an (N,H,W,C) batch
+        and can fill a preallocated (N,C,H,W) buffer `out`, e.g. a shared-memory slot of the `DataLoader`.
+        Only for tfm_y=TfmType.NO; the stats are taken from `normalizer`, per source like `Normalize` does.
+    """
+
+    batchable = True
+    uses_src_idx = True
+    fills_out = True  # batch_call takes an `out` buffer
+
+    def __init__(self, normalizer, dtype=np.float32):
+        self.norm, self.dtype, self.tfm_y = normalizer, np.dtype(dtype), TfmType.NO
+        # stats as (C,1,1) float32, ready to broadcast against (C,H,W)
+        chw = lambda m, s: (np.asarray(m, np.float32)[:, None, None], np.asarray(s, np.float32)[:, None, None])
+        if normalizer.d:
+            self.d = {k: chw(*v) for k, v in normalizer.d.items()}
+        else:
+            self.d = None
+            self.m, self.s = chw(normalizer.m, normalizer.s)
+
+    def fill(self, out, x, m, s):
+        np.subtract(np.moveaxis(x, -1, -3), m, out=out, casting='unsafe')
+        np.divide(out, s, out=out, casting='unsafe')
+        return out
+
+    def __call__(self, x, y=None, src_idx=None):
+        if self.d and y is not None:
+            m, s = self.d[src_idx if src_idx is not None else y]
+        else:
+            m, s = self.m, self.s
+        h, w, c = x.shape
+        return self.fill(np.empty((c, h, w), self.dtype), x, m, s), y
+
+    def batch_call(self, x, y, src_idx, out=None):
+        """ Normalizes a collated (N,H,W,C) batch into (N,C,H,W); src_idx entries of -1 fall back to the class label y. """
+        n, h, w, c = x.shape
+        out = np.empty((n, c, h, w), self.dtype) if out is None else out[:n]
+        if not self.d: return self.fill(out, x, self.m, self.s)
+        keys = np.where(src_idx >= 0, src_idx, y)
+        u_keys, inv = np.unique(keys, return_inverse=True)
+        m = np.stack([self.d[k][0] for k in u_keys])[inv]
+        s = np.stack([self.d[k][1] for k in u_keys])[inv]
+        return self.fill(out, x, m, s)
+
+
 def to_bb(YY, y="deprecated"):
     """Convert mask YY to a bounding box, assumes 0 as background nonzero object"""
     cols, rows = np.nonzero(YY)
@@ -300,12 +365,23 @@ class Transform():
             type of transform
     """
 
+    batchable = False  # (!) True if the transform also implements `do_batch_transform`, see `Transforms(batch_mode=True)`
+
     def __init__(self, tfm_y=TfmType.NO):
         self.tfm_y = tfm_y
         self.store = threading.local()
 
     def set_state(self): pass
 
+    def set_batch_state(self, n): pass
+
+    def batch_call(self, x, y, src_idx):
+        """ Applies the transform to a collated (N,H,W,C) batch, drawing the random parameters per sample. """
+        self.set_batch_state(len(x))
+        return self.do_batch_transform(x)
+
+    def do_batch_transform(self, x): raise NotImplementedError
+
     def __call__(self, x, y):
         self.set_state()
         x, y = ((self.transform(x), y) if self.tfm_y == TfmType.NO
@@ -382,9 +458,16 @@ class CenterCrop(CoordTransform):
         super().__init__(tfm_y)
         self.min_sz, self.sz_y = sz, sz_y
 
+    batchable = True
+
     def do_transform(self, x, is_y):
         return center_crop(x, self.sz_y if is_y else self.min_sz)
 
+    def do_batch_transform(self, x):
+        _, r, c, *_ = x.shape
+        start_r, start_c = math.ceil((r - self.min_sz) / 2), math.ceil((c - self.min_sz) / 2)
+        return x[:, start_r:start_r + self.min_sz, start_c:start_c + self.min_sz]
+
 
 class RandomCrop(CoordTransform):
     """ A class that represents a Random Crop transformation.
@@ -402,10 +485,16 @@ class RandomCrop(CoordTransform):
         super().__init__(tfm_y)
         self.targ_sz, self.sz_y = targ_sz, sz_y
 
+    batchable = True
+
     def set_state(self):
         self.store.rand_r = random.uniform(0, 1)
         self.store.rand_c = random.uniform(0, 1)
 
+    def set_batch_state(self, n):
+        self.store.rand_r = np.random.uniform(0, 1, n)
+        self.store.rand_c = np.random.uniform(0, 1, n)
+
     def do_transform(self, x, is_y):
         r, c, *_ = x.shape
         sz = self.sz_y if is_y else self.targ_sz
@@ -413,6 +502,13 @@ class RandomCrop(CoordTransform):
         start_c = np.floor(self.store.rand_c * (c - sz)).astype(int)
         return crop(x, start_r, start_c, sz)
 
+    def do_batch_transform(self, x):
+        n, r, c, *_ = x.shape
+        sz = np.arange(self.targ_sz)
+        rows = np.floor(self.store.rand_r * (r - self.targ_sz)).astype(int)[:, None] + sz
+        cols = np.floor(self.store.rand_c * (c - self.targ_sz)).astype(int)[:, None] + sz
+        return x[np.arange(n)[:, None, None], rows[:, :, None], cols[:, None, :]]
+
 
 class NoCrop(CoordTransform):
     """  A transformation that resize to a square image without cropping.
@@ -547,34 +643,65 @@ class RandomDihedral(CoordTransform):  # (!)
     Please reference D8(dihedral group of order eight), the group of all symmetries of the square.
     """
 
+    batchable = True
+
     def set_state(self):
         self.store.rot_times = random.randint(0, 3)
         self.store.do_flip = random.random() < 0.5
 
+    def set_batch_state(self, n):
+        self.store.rot_times = np.random.randint(0, 4, n)
+        self.store.do_flip = np.random.random(n) < 0.5
+
     def do_transform(self, x, is_y):
         x = np.rot90(x, self.store.rot_times)
         return np.fliplr(x).copy() if self.store.do_flip else x
 
+    def do_batch_transform(self, x):
+        if x.shape[1] != x.shape[2]: raise ValueError('batched RandomDihedral needs square images')
+        out = np.empty_like(x)
+        for dih in range(8): # one vectorized op per element of D8 present in the batch
+            idx = np.flatnonzero((self.store.rot_times == dih % 4) & (self.store.do_flip == (dih >= 4)))
+            if len(idx) == 0: continue
+            xs = np.rot90(x[idx], dih % 4, axes=(1, 2))
+            out[idx] = xs[:, :, ::-1] if dih >= 4 else xs
+        return out
+
 
 class RandomFlip(CoordTransform):
     def __init__(self, tfm_y=TfmType.NO, p=0.5):
         super().__init__(tfm_y=tfm_y)
         self.p = p
 
+    batchable = True
+
     def set_state(self): self.store.do_flip = random.random() < self.p
 
+    def set_batch_state(self, n): self.store.do_flip = np.random.random(n) < self.p
+
     def do_transform(self, x, is_y): return np.fliplr(x).copy() if self.store.do_flip else x
 
+    def do_batch_transform(self, x):
+        out = x.copy()
+        out[self.store.do_flip] = x[self.store.do_flip, :, ::-1]
+        return out
+
 
 class RandomLighting(Transform):
     def __init__(self, b, c, tfm_y=TfmType.NO):
         super().__init__(tfm_y)
         self.b, self.c = b, c
 
+    batchable = True
+
     def set_state(self):
         self.store.b_rand = rand0(self.b)
         self.store.c_rand = rand0(self.c)
 
+    def set_batch_state(self, n):
+        self.store.b_rand = np.random.uniform(-self.b, self.b, n)
+        self.store.c_rand = np.random.uniform(-self.c, self.c, n)
+
     def do_transform(self, x, is_y):
         if is_y and self.tfm_y != TfmType.PIXEL: return x
         b = self.store.b_rand
@@ -583,6 +710,13 @@ class RandomLighting(Transform):
         x = lighting(x, b, c)
         return x
 
+    def do_batch_transform(self, x):
+        b, c = self.store.b_rand, self.store.c_rand
+        c = np.where(c < 0, -1 / (c - 1), c + 1)
+        b, c = b[:, None, None, None], c[:, None, None, None]
+        mu = x.mean(axis=tuple(range(1, x.ndim)), keepdims=True)
+        return np.clip((x - mu) * c + mu + b, 0., 1.).astype(np.float32)
+
 
 class RandomRotateZoom(CoordTransform):
     """ 
@@ -723,20 +857,25 @@ class GoogleNetResize(CoordTransform):
                                 interpolation=interpolation)
 
 
-def compose(im, y, src_idx, fns): # (!)
-    """ apply a collection of transformation functions fns to images
-        (!) this calls e.g. 'normalize' with x and y inputs. 
-    """
+def resolve_tfms(fns):
+    """ (!) Pairs each transform with its `uses_src_idx` capability, so applying them needs no per-sample dispatch. """
+    return [(fn, getattr(fn, 'uses_src_idx', False)) for fn in fns]
 
-    for fn in fns:
-        if 'Normalize' in str(fn):
-            # print(fn) # (!)
-            im, y = fn(im, y, src_idx)
-        else: im, y = fn(im, y)
 
+def run_tfms(im, y, src_idx, pipeline):
+    """ (!) Applies (fn, uses_src_idx) pairs from `resolve_tfms`; only transforms that use src_idx get it. """
+    for fn, uses_src_idx in pipeline:
+        im, y = fn(im, y, src_idx) if uses_src_idx else fn(im, y)
     return im if y is None else (im, y)
 
 
+def compose(im, y, src_idx, fns): # (!)
+    """ apply a collection of transformation functions fns to images
+        (!) transforms with `uses_src_idx` (e.g. Normalize) are also given src_idx.
+    """
+    return run_tfms(im, y, src_idx, resolve_tfms(fns))
+
+
 class CropType(IntEnum):
     """ Type of image cropping.
     """
@@ -752,23 +891,57 @@ crop_fn_lu = {CropType.RANDOM: RandomCrop, CropType.CENTER: CenterCrop, CropType
 
 class Transforms:
     def __init__(self, sz, tfms, normalizer, denorm, crop_type=CropType.CENTER,
-                 tfm_y=TfmType.NO, sz_y=None):
+                 tfm_y=TfmType.NO, sz_y=None, batch_mode=False, fused=True, dtype=np.float32):
+        """
+        fused: (!) with a `Normalize` normalizer and tfm_y=TfmType.NO, normalize, reorder to channels-first and
+            convert to `dtype` in a single `FusedNormalize` stage instead of `Normalize` + `ChannelOrder`.
+        batch_mode: (!) split the pipeline after its last transform that is not `batchable`. Samples only go through
+            the first part; the trailing batchable transforms (dihedral, flip, lighting, crop, normalize, channel
+            order) run on the whole collated (N,H,W,C) batch via `batch_call`, which the `DataLoader` applies.
+        """
         if sz_y is None: sz_y = sz
         self.sz, self.denorm, self.norm, self.sz_y = sz, denorm, normalizer, sz_y
         crop_tfm = crop_fn_lu[crop_type](sz, tfm_y, sz_y)
         self.tfms = tfms
         self.tfms.append(crop_tfm)
-        if normalizer is not None: self.tfms.append(normalizer)
-        self.tfms.append(ChannelOrder(tfm_y))
-
-
-    def __call__(self, im, y=None, src_idx=None): return compose(im, y, src_idx, self.tfms) #(!)
+        if fused and type(normalizer) is Normalize and tfm_y == TfmType.NO:
+            self.tfms.append(FusedNormalize(normalizer, dtype))
+        else:
+            if normalizer is not None: self.tfms.append(normalizer)
+            self.tfms.append(ChannelOrder(tfm_y))
+
+        self.batch_mode = batch_mode
+        if batch_mode:
+            if tfm_y != TfmType.NO: raise ValueError('batch_mode only supports tfm_y=TfmType.NO')
+            split = len(self.tfms)
+            while split and getattr(self.tfms[split - 1], 'batchable', False): split -= 1
+            self.sample_tfms, self.batch_tfms = self.tfms[:split], self.tfms[split:]
+        # (!) resolved once; call `resolve` again after editing self.tfms
+        self.resolve()
+
+    def resolve(self):
+        self.pipeline = resolve_tfms(self.sample_tfms if self.batch_mode else self.tfms)
+
+    def __call__(self, im, y=None, src_idx=None):
+        if not self.batch_mode: return run_tfms(im, y, src_idx, self.pipeline) #(!)
+        res = run_tfms(im, y, src_idx, self.pipeline)
+        im, y = res if y is not None else (res, y)
+        return im, y, -1 if src_idx is None else src_idx  # src_idx is needed again by the batch stage
+
+    def batch_call(self, x, y, src_idx, out=None):
+        """ Applies the batch stage of a `batch_mode` pipeline to collated x, y and src_idx arrays.
+            A final `FusedNormalize` writes x into `out` when it is given. """
+        for fn in self.batch_tfms:
+            if out is not None and fn is self.batch_tfms[-1] and getattr(fn, 'fills_out', False):
+                x = fn.batch_call(x, y, src_idx, out=out)
+            else: x = fn.batch_call(x, y, src_idx)
+        return [x, y]
 
     def __repr__(self): return str(self.tfms)
 
 
 def image_gen(normalizer, denorm, sz, tfms=None, max_zoom=None, pad=0, crop_type=None,
-              tfm_y=None, sz_y=None, pad_mode=cv2.BORDER_REFLECT, scale=None):
+              tfm_y=None, sz_y=None, pad_mode=cv2.BORDER_REFLECT, scale=None, batch_mode=False):
     """
     Generate a standard set of transformations
 
@@ -794,6 +967,8 @@ def image_gen(normalizer, denorm, sz, tfms=None, max_zoom=None, pad=0, crop_type
          y size, height
      pad_mode :
          cv2 padding style: repeat, reflect, etc.
+     batch_mode :
+         apply the trailing batchable transforms per batch, see ``Transforms``
 
     Returns
     -------
@@ -818,7 +993,7 @@ def image_gen(normalizer, denorm, sz, tfms=None, max_zoom=None, pad=0, crop_type
     if pad: scale.append(AddPadding(pad, mode=pad_mode))
     if crop_type != CropType.GOOGLENET: tfms = scale + tfms
     return Transforms(sz, tfms, normalizer, denorm, crop_type,
-                      tfm_y=tfm_y, sz_y=sz_y)
+                      tfm_y=tfm_y, sz_y=sz_y, batch_mode=batch_mode)
 
 
 def noop(x):
@@ -853,8 +1028,9 @@ def tfms_from_stats_dict(tfms_dict, sz, aug_tfms=None, max_zoom=None, pad=0, cro
 
 
 def tfms_from_stats(stats, sz, aug_tfms=None, max_zoom=None, pad=0, crop_type=CropType.RANDOM,
-                    tfm_y=None, sz_y=None, pad_mode=cv2.BORDER_REFLECT, norm_y=True, scale=None):
+                    tfm_y=None, sz_y=None, pad_mode=cv2.BORDER_REFLECT, norm_y=True, scale=None, batch_mode=False):
     """ Given the statistics of the training image sets, returns separate training and validation transform functions
+        (!) batch_mode: apply the trailing batchable transforms per batch, see `Transforms`
     """
 
     if aug_tfms is None: aug_tfms=[]
@@ -862,9 +1038,10 @@ def tfms_from_stats(stats, sz, aug_tfms=None, max_zoom=None, pad=0, crop_type=Cr
     tfm_denorm = Denormalize(stats) if stats is not None else None
     val_crop = CropType.CENTER if crop_type in (CropType.RANDOM,CropType.GOOGLENET) else crop_type
     val_tfm = image_gen(tfm_norm, tfm_denorm, sz, pad=pad, crop_type=val_crop,
-                        tfm_y=tfm_y, sz_y=sz_y, scale=scale)
+                        tfm_y=tfm_y, sz_y=sz_y, scale=scale, batch_mode=batch_mode)
     trn_tfm = image_gen(tfm_norm, tfm_denorm, sz, pad=pad, crop_type=crop_type,
-            tfm_y=tfm_y, sz_y=sz_y, tfms=aug_tfms, max_zoom=max_zoom, pad_mode=pad_mode, scale=scale)
+            tfm_y=tfm_y, sz_y=sz_y, tfms=aug_tfms, max_zoom=max_zoom, pad_mode=pad_mode, scale=scale,
+            batch_mode=batch_mode)
     return trn_tfm, val_tfm 
 
 